@@ -1,4 +1,26 @@
-def render_frames(m, name, frames=[1], framerate=60, resolution=[1280,720]):
+import os
+import json
+import time
+
+def record_timings(m, frames, passes):
+    '''
+    Add frame and profiler timings to timings.json in the capture directory, which run_image_tests.py
+    created with the Mogwai startup time and adds to the test report.
+    '''
+    path = os.path.join(m.frameCapture.outputDir, 'timings.json')
+    try:
+        with open(path) as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        timings = {}
+    if 'scene_load' not in timings and 'script_start' in timings:
+        timings['scene_load'] = frames[0][0] - timings['script_start']
+    timings.setdefault('frames', []).extend(end - start for start, end in frames)
+    timings.setdefault('passes', {}).update(passes)
+    with open(path, 'w') as f:
+        json.dump(timings, f)
+
+def render_frames(m, name, frames=[1], framerate=60, resolution=[1280,720], profile=False):
     m.resizeSwapChain(*resolution)
     m.ui = False
     m.clock.framerate = framerate
@@ -6,10 +28,28 @@ def render_frames(m, name, frames=[1], framerate=60, resolution=[1280,720]):
     m.clock.pause()
     m.frameCapture.baseFilename = name
 
+    # Capture the GPU time of each render pass if requested.
+    if profile:
+        m.profiler.enabled = True
+        m.profiler.startCapture(frames[-1])
+
     frame = 0
+    frame_times = []
     for capture_frame in frames:
         while frame < capture_frame:
             frame += 1
             m.clock.frame = frame
+            start = time.time()
             m.renderFrame()
+            frame_times.append((start, time.time()))
         m.frameCapture.capture()
+
+    # Profiler lanes are named '<event>/gpuTime' and measured in ms.
+    passes = {}
+    if profile:
+        capture = m.profiler.endCapture()
+        m.profiler.enabled = False
+        if capture:
+            passes = {name[:-len('/gpuTime')]: lane['stats']['mean'] / 1000 for name, lane in capture['events'].items() if name.endswith('/gpuTime')}
+
+    record_timings(m, frame_times, passes)
@@ -13,6 +13,12 @@ DEFAULT_TOLERANCE = 1e-12
 # Default image test timeout.
 DEFAULT_TIMEOUT = 600
 
+# Default relative tolerance of test timings against a baseline run before they are flagged as a performance regression.
+DEFAULT_PERF_TOLERANCE = 0.2
+
+# Timings which are slower than the baseline by less than this (in seconds) are never flagged.
+PERF_MIN_DELTA = 0.001
+
 IMAGE_TESTS_DIR = "Tests/image_tests"
 
 # Supported image extensions.
@@ -21,6 +27,9 @@ IMAGE_EXTENSIONS = ['.png', '.jpg', '.tga', '.bmp', '.pfm', '.exr']
 # Suffix to use for error images.
 ERROR_IMAGE_SUFFIX = '.error.png'
 
+# Number of threads comparing the images of a test (None uses the ThreadPoolExecutor default).
+IMAGE_COMPARE_WORKERS = None
+
 if os.name == 'nt':
 
     # Build configurations.
@@ -0,0 +1,285 @@
+'''
+Module for comparing images in-process.
+Computes the same error metrics as Source/Tools/ImageCompare without launching a process per image.
+'''
+
+import sys
+import math
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+# Image extensions supported by the readers in this module. Other formats need ImageCompare.
+SUPPORTED_EXTENSIONS = ['.png', '.pfm', '.exr']
+
+def _mse(a, b, n):
+    return np.square(a[..., :n] - b[..., :n]).astype(np.float64).sum(axis=-1) / n
+
+def _rmse(a, b, n):
+    a, b = a[..., :n], b[..., :n]
+    return (np.square(a - b).astype(np.float64) / (np.square(a).astype(np.float64) + 1e-3)).sum(axis=-1) / n
+
+def _mape(a, b, n):
+    a, b = a[..., :n], b[..., :n]
+    return 100.0 * np.abs((a - b).astype(np.float64) / (a.astype(np.float64) + 1e-3)).sum(axis=-1) / n
+
+# Per-pixel error metrics, matching ImageCompare including its MAE which sums squared differences.
+METRICS = {
+    'mse': _mse,
+    'rmse': _rmse,
+    'mae': _mse,
+    'mape': _mape,
+}
+
+class ImageError(Exception):
+    pass
+
+def load_image(path):
+    '''
+    Load an image as a (height, width, 4) float32 RGBA array, top row first.
+    Like ImageCompare (FreeImage), 8 and 16 bit images are normalized to [0, 1],
+    grayscale is replicated to RGB and a missing alpha channel is set to 1.
+    '''
+    path = Path(path)
+    ext = path.suffix.lower()
+    if ext == '.png':
+        return read_png(path)
+    elif ext == '.pfm':
+        return read_pfm(path)
+    elif ext == '.exr':
+        return read_exr(path)
+    raise ImageError(f'Unsupported image format "{ext}"')
+
+def _to_rgba(img):
+    '''
+    Expand a (height, width, channels) float32 image with 1 to 4 channels to RGBA.
+    '''
+    h, w, c = img.shape
+    rgba = np.ones((h, w, 4), dtype=np.float32)
+    if c <= 2:
+        rgba[..., :3] = img[..., 0:1]
+        if c == 2:
+            rgba[..., 3] = img[..., 1]
+    else:
+        rgba[..., :c] = img
+    return rgba
+
+def read_pfm(path):
+    '''
+    Read a PFM image. Scanlines are stored bottom to top.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = []
+    pos = 0
+    while len(header) < 4:
+        # Header fields are separated by whitespace: type, width, height and scale.
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        end = pos
+        while not data[end:end + 1].isspace():
+            end += 1
+        header.append(data[pos:end].decode('ascii'))
+        pos = end
+    pos += 1
+    if header[0] not in ('PF', 'Pf'):
+        raise ImageError(f'Invalid PFM header in "{path}"')
+    channels = 3 if header[0] == 'PF' else 1
+    width, height, scale = int(header[1]), int(header[2]), float(header[3])
+    dtype = '<f4' if scale < 0 else '>f4'
+    img = np.frombuffer(data, dtype=dtype, count=width * height * channels, offset=pos)
+    img = img.reshape(height, width, channels)[::-1].astype(np.float32)
+    return _to_rgba(img)
+
+def read_exr(path):
+    '''
+    Read the RGB(A) or single channel of the root layer of an EXR image with scripts/exr.py.
+    '''
+    # scripts/exr.py lives in the project directory and needs OpenEXR, which is only required for EXR tests.
+    project_dir = str(Path(__file__).parents[3])
+    if project_dir not in sys.path:
+        sys.path.append(project_dir)
+    from scripts import exr
+
+    f = exr.open(str(path))
+    names = f.channel_map.get('default', [])
+    if len(names) == 0:
+        raise ImageError(f'No root channels in "{path}"')
+    # Root channels are sorted R, G, B, A first.
+    img = f.get('default')
+    if names[:3] == ['R', 'G', 'B']:
+        return _to_rgba(img[..., :4 if names[3:4] == ['A'] else 3])
+    return _to_rgba(img[..., :1])
+
+def _paeth(a, b, c):
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+def _unfilter(data, height, stride, bpp):
+    '''
+    Undo the PNG scanline filters. Returns (height, stride) uint8 bytes.
+    '''
+    rows = np.frombuffer(data, dtype=np.uint8, count=height * (stride + 1)).reshape(height, stride + 1)
+    types = rows[:, 0].astype(np.int16)
+    if np.any(types > 4):
+        raise ImageError('Invalid PNG filter type')
+    units = stride // bpp
+    filtered = rows[:, 1:].reshape(height, units, bpp).astype(np.int16)
+
+    if np.all(types <= 2):
+        # None, Sub and Up only depend on the left pixel or the row above, reconstruct row by row.
+        out = np.empty((height, units, bpp), dtype=np.uint8)
+        prev = np.zeros((units, bpp), dtype=np.uint8)
+        for y in range(height):
+            if types[y] == 0:
+                out[y] = filtered[y]
+            elif types[y] == 1:
+                np.cumsum(filtered[y], axis=0, dtype=np.uint8, out=out[y])
+            else:
+                out[y] = (filtered[y] + prev) & 0xff
+            prev = out[y]
+        return out.reshape(height, stride)
+
+    # Average and Paeth depend on the left, upper and upper left pixels. Pixel (y, x) only depends on
+    # the two previous anti-diagonals x + y = k - 1 and k - 2, so the rows are skewed by y to reconstruct
+    # one anti-diagonal at a time from contiguous slices. Positions outside of the image stay zero like the padding.
+    ys, xs = np.mgrid[0:height, 0:units]
+    skewed = np.zeros((height + units + 1, height + 1, bpp), dtype=np.int16)
+    skewed[xs + ys + 2, ys + 1] = filtered
+    masks = [(types == t).astype(np.int16)[:, None] for t in range(1, 5)]
+    for k in range(2, height + units + 1):
+        # Rows y whose pixel x = k - 2 - y is inside the image.
+        y0, y1 = max(0, k - 1 - units), min(height, k - 1)
+        a = skewed[k - 1, y0 + 1:y1 + 1]
+        b = skewed[k - 1, y0:y1]
+        c = skewed[k - 2, y0:y1]
+        m = [mask[y0:y1] for mask in masks]
+        pred = m[0] * a + m[1] * b + m[2] * ((a + b) >> 1) + m[3] * _paeth(a, b, c)
+        skewed[k, y0 + 1:y1 + 1] = (skewed[k, y0 + 1:y1 + 1] + pred) & 0xff
+    return skewed[xs + ys + 2, ys + 1].astype(np.uint8).reshape(height, stride)
+
+def read_png(path):
+    '''
+    Read a non-interlaced PNG image of any color type and bit depth.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ImageError(f'"{path}" is not a PNG image')
+
+    # Collect chunks.
+    pos = 8
+    idat = []
+    palette = None
+    transparency = None
+    while pos < len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b'IHDR':
+            width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif chunk_type == b'PLTE':
+            palette = np.frombuffer(chunk, dtype=np.uint8).reshape(-1, 3)
+        elif chunk_type == b'tRNS':
+            transparency = chunk
+        elif chunk_type == b'IDAT':
+            idat.append(chunk)
+        elif chunk_type == b'IEND':
+            break
+    if interlace != 0:
+        raise ImageError(f'Interlaced PNG "{path}" is not supported')
+
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    bits = channels * depth
+    stride = (width * bits + 7) // 8
+    raw = _unfilter(zlib.decompress(b''.join(idat)), height, stride, max(1, bits // 8))
+
+    # Unpack samples.
+    if depth == 16:
+        samples = raw.view('>u2').reshape(height, width, channels)
+    elif depth == 8:
+        samples = raw.reshape(height, width, channels)
+    else:
+        shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+        samples = ((raw[:, :, None] >> shifts) & ((1 << depth) - 1)).reshape(height, -1)[:, :width, None]
+
+    if color_type == 3:
+        alpha = np.full(len(palette), 255, dtype=np.uint8)
+        if transparency is not None:
+            alpha[:len(transparency)] = np.frombuffer(transparency, dtype=np.uint8)
+        index = samples[..., 0]
+        img = np.concatenate([palette[index], alpha[index][..., None]], axis=-1).astype(np.float32) / 255
+        return img
+    img = samples.astype(np.float32) / ((1 << depth) - 1)
+    return _to_rgba(img)
+
+def write_png(path, img):
+    '''
+    Write a (height, width, 4) float RGBA image in [0, 1] as 8 bit PNG.
+    Values are truncated like ImageCompare does.
+    '''
+    height, width, _ = img.shape
+    pixels = np.clip((img * 255).astype(np.int32), 0, 255).astype(np.uint8)
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), pixels.reshape(height, -1)], axis=1)
+
+    def chunk(chunk_type, payload):
+        return struct.pack('>I', len(payload)) + chunk_type + payload + struct.pack('>I', zlib.crc32(chunk_type + payload))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+# Heat map colors from low to high error.
+HEAT_MAP_COLORS = np.array([
+    [0, 0, 1],
+    [0, 1, 1],
+    [0, 1, 0],
+    [1, 1, 0],
+    [1, 0, 0],
+], dtype=np.float32)
+
+def heat_map(error_map):
+    '''
+    Map per-pixel errors to colors, normalized to the range of the errors.
+    '''
+    lo, hi = np.nanmin(error_map), np.nanmax(error_map)
+    t = np.clip((error_map - lo) / max(np.float32(1e-5), hi - lo), 0, 1)
+    t4 = t * 4
+    c = np.clip(np.floor(t4).astype(np.int32), 0, 3)
+    f = (t4 - c)[..., None]
+    rgba = np.ones(error_map.shape + (4,), dtype=np.float32)
+    rgba[..., :3] = HEAT_MAP_COLORS[c] + f * (HEAT_MAP_COLORS[c + 1] - HEAT_MAP_COLORS[c])
+    return rgba
+
+def compare_images(file_a, file_b, metric='mse', threshold=0.0, alpha=False, heat_map_file=None):
+    '''
+    Compare two images like ImageCompare.
+    Returns a tuple containing a boolean to indicate success and the error, which is NaN if the images
+    cannot be compared. Errors are accepted if they are finite and within the threshold, which
+    ImageCompare takes as 32 bit float.
+    '''
+    try:
+        a = load_image(file_a)
+        b = load_image(file_b)
+    except Exception as e:
+        print(f'Cannot load image ({e}).', file=sys.stderr)
+        return False, math.nan
+    if a.shape != b.shape:
+        print('Cannot compare images with different resolutions.', file=sys.stderr)
+        return False, math.nan
+
+    error_map = METRICS[metric](a, b, 4 if alpha else 3)
+    error = float(error_map.sum() / error_map.size)
+
+    if heat_map_file:
+        write_png(heat_map_file, heat_map(error_map.astype(np.float32)))
+
+    if math.isnan(error) or math.isinf(error):
+        return False, error
+    return error <= float(np.float32(threshold)), error
@@ -0,0 +1,104 @@
+'''
+Module for collecting and comparing image test timings.
+'''
+
+import json
+from pathlib import Path
+
+from . import config
+
+# Timings file written into the test output directory by Mogwai (see image_tests/helpers.py).
+TIMINGS_FILE = 'timings.json'
+
+def load_timings(output_dir, total):
+    '''
+    Load the timings recorded while generating the images of a test and summarize them.
+    total is the wall-clock time of the Mogwai process.
+    Returns a dictionary with times in seconds:
+      total       Mogwai process
+      startup     Mogwai launch until the test script starts
+      scene_load  Test script start until the first frame, dominated by loading the scene
+      frame       Statistics of the per-frame render times (count, mean, min, max)
+      passes      Mean GPU time of each profiler event, if the test captured a profile
+    '''
+    timings = {'total': total}
+    try:
+        with open(Path(output_dir) / TIMINGS_FILE) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return timings
+    for key in ['startup', 'scene_load']:
+        if key in recorded:
+            timings[key] = recorded[key]
+    frames = recorded.get('frames', [])
+    if frames:
+        timings['frame'] = {
+            'count': len(frames),
+            'mean': sum(frames) / len(frames),
+            'min': min(frames),
+            'max': max(frames)
+        }
+    if recorded.get('passes'):
+        timings['passes'] = recorded['passes']
+    return timings
+
+def flatten_timings(timings):
+    '''
+    Return the compared metrics of a timings dictionary as a flat dictionary of name -> seconds.
+    '''
+    metrics = {k: timings[k] for k in ['total', 'startup', 'scene_load'] if k in timings}
+    if 'frame' in timings:
+        metrics['frame'] = timings['frame']['mean']
+    for name, value in timings.get('passes', {}).items():
+        metrics['pass/' + name] = value
+    return metrics
+
+def compare_timings(timings, baseline, tolerance):
+    '''
+    Compare timings against baseline timings.
+    A metric regressed if it is slower than the baseline by more than the relative tolerance
+    and by more than config.PERF_MIN_DELTA seconds, which ignores noise in very short timings.
+    Returns a list of regressions.
+    '''
+    current = flatten_timings(timings)
+    base = flatten_timings(baseline)
+    regressions = []
+    for name, value in current.items():
+        if name not in base or base[name] <= 0:
+            continue
+        if value > base[name] * (1 + tolerance) and value - base[name] > config.PERF_MIN_DELTA:
+            regressions.append({
+                'metric': name,
+                'value': value,
+                'baseline': base[name],
+                'ratio': value / base[name]
+            })
+    return regressions
+
+def format_time(seconds):
+    '''
+    Format a time in seconds using ms for short times.
+    '''
+    return f'{seconds * 1000:.2f} ms' if seconds < 1 else f'{seconds:.2f} s'
+
+def load_baseline(report_dir, jobs):
+    '''
+    Load the timings from the report of a test in a baseline run.
+    Returns None if the test did not run or did not pass in the baseline, regressed timings are no baseline,
+    or if the baseline ran with a different number of jobs than the current run, as concurrent tests slow each other down.
+    '''
+    try:
+        with open(Path(report_dir) / 'report.json') as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if report.get('result') != 'PASSED' or report.get('jobs') != jobs:
+        return None
+    return report.get('timings')
+
+def format_regression(regression):
+    '''
+    Format a regression as a message for the test output.
+    '''
+    r = regression
+    return f'{r["metric"]} is {r["ratio"] - 1:.0%} slower than the baseline ({format_time(r["baseline"])} -> {format_time(r["value"])})'
@@ -0,0 +1,188 @@
+'''
+Module for reusing image test results when nothing affecting a test has changed.
+'''
+
+import os
+import re
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+# Build outputs which do not affect rendering.
+IGNORED_BINARY_SUFFIXES = ['.pdb', '.lib', '.exp', '.ilk', '.log', '.txt']
+
+# Quoted paths to scene and asset files in test, graph and scene scripts.
+ASSET_REGEX = re.compile(r'''['"]([^'"\n]+\.(?:pyscene|fbx|gltf|glb|obj|usd|usda|usdc|hdr|exr|png|jpg|tga|bmp|dds|vdb|nvdb))['"]''', re.IGNORECASE)
+
+# Imported modules in test and graph scripts.
+IMPORT_REGEX = re.compile(r'^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w.]+))', re.MULTILINE)
+
+# Name of the file hash memo in the result directory.
+HASH_MEMO_FILE = '.hash_memo.json'
+
+class ResultCache:
+    '''
+    Computes cache keys of tests and looks up previous results.
+    A key hashes the test script, the scripts it imports (e.g. graphs/*.py), the scene and asset
+    files referenced by them, the Mogwai and render pass binaries, the reference images and the tolerance.
+    A test with the key of its previous PASSED report in the result directory reuses the images of that run.
+    With reuse disabled, keys are still computed and stored in the reports for later runs.
+    File contents are hashed once and memoized by size and modification time.
+    '''
+
+    def __init__(self, result_dir, data_dirs, reuse=True):
+        self.result_dir = Path(result_dir)
+        self.data_dirs = [Path(d) for d in data_dirs]
+        self.reuse = reuse
+        self.memo_file = self.result_dir / HASH_MEMO_FILE
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cached_tests = []
+        self.binaries_hash = None
+        try:
+            with open(self.memo_file) as f:
+                self.memo = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def file_hash(self, path):
+        '''
+        Return the SHA-256 of a file, or None if it does not exist.
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = str(Path(path).resolve())
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self.memo.get(key)
+            if entry and entry[:2] == stamp:
+                return entry[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock:
+            self.memo[key] = stamp + [digest]
+        return digest
+
+    def hash_binaries(self, build_dir, mogwai_exe):
+        '''
+        Hash Mogwai, the render pass libraries and the shaders and data deployed with them.
+        '''
+        files = {}
+        for root, _, names in os.walk(build_dir):
+            for name in names:
+                if Path(name).suffix.lower() not in IGNORED_BINARY_SUFFIXES:
+                    path = Path(root) / name
+                    files[path.relative_to(build_dir).as_posix()] = self.file_hash(path)
+        files['mogwai'] = self.file_hash(mogwai_exe)
+        self.binaries_hash = _digest(files)
+        return self.binaries_hash
+
+    def _scripts(self, script_file):
+        '''
+        Collect a script and the local modules it imports, recursively.
+        Modules are searched next to the test script and one level up, matching the sys.path of the test scripts.
+        '''
+        search_dirs = [script_file.parent, script_file.parent.parent]
+        scripts = {}
+        todo = [script_file]
+        while todo:
+            path = todo.pop()
+            if path in scripts:
+                continue
+            scripts[path] = path.read_text(errors='replace')
+            for m in IMPORT_REGEX.finditer(scripts[path]):
+                parts = (m.group(1) or m.group(2)).split('.')
+                for d in search_dirs:
+                    module = d.joinpath(*parts).with_suffix('.py')
+                    if module.exists():
+                        todo.append(module)
+                        break
+        return scripts
+
+    def _resolve_asset(self, name, base_dir):
+        for d in [base_dir] + self.data_dirs:
+            path = d / name
+            if path.is_file():
+                return path
+        return None
+
+    def _assets(self, texts, base_dir):
+        '''
+        Hash the asset files referenced in texts, following references in scene scripts.
+        Assets which cannot be found are keyed by name only.
+        '''
+        assets = {}
+        todo = [(name, base_dir) for text in texts for name in ASSET_REGEX.findall(text)]
+        while todo:
+            name, base = todo.pop()
+            if name in assets:
+                continue
+            path = self._resolve_asset(name, base)
+            assets[name] = self.file_hash(path) if path else None
+            if path and path.suffix.lower() == '.pyscene':
+                text = path.read_text(errors='replace')
+                todo += [(n, path.parent) for n in ASSET_REGEX.findall(text)]
+        return assets
+
+    def key(self, test, ref_dir):
+        '''
+        Compute the cache key of a test.
+        '''
+        scripts = self._scripts(test.script_file)
+        root = test.script_file.parent.parent
+        ref_dir = ref_dir / test.test_dir
+        refs = {str(image): self.file_hash(ref_dir / image) for image in test.collect_images(ref_dir)} if ref_dir.exists() else {}
+        return _digest({
+            'scripts': {os.path.relpath(p, root): hashlib.sha256(t.encode('utf-8')).hexdigest() for p, t in scripts.items()},
+            'assets': self._assets(scripts.values(), test.script_file.parent),
+            'binaries': self.binaries_hash,
+            'refs': refs,
+            'tolerance': test.tolerance,
+        })
+
+    def lookup(self, test, key):
+        '''
+        Return the previous report of a test if it PASSED with the same key and its images still exist.
+        '''
+        report_dir = self.result_dir / test.test_dir
+        report = None
+        if self.reuse:
+            try:
+                with open(report_dir / 'report.json') as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if (report and report.get('cache_key') == key and report.get('result') == 'PASSED' and
+            set(i['name'] for i in report['images']) <= set(map(str, test.collect_images(report_dir)))):
+            with self.lock:
+                self.hits += 1
+                self.cached_tests.append(test.name)
+            return report
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def stats(self):
+        return {'enabled': self.reuse, 'hits': self.hits, 'misses': self.misses, 'tests': sorted(self.cached_tests)}
+
+    def save(self):
+        '''
+        Write the file hash memo.
+        '''
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.memo_file.with_suffix('.tmp')
+        with self.lock:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.memo, f)
+        os.replace(tmp_file, self.memo_file)
+
+def _digest(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,80 @@
+'''
+Stand-in for Mogwai to exercise the image test scheduler without a GPU.
+Use with: run_image_tests.py --mogwai Tests/testing/mock_mogwai.py
+
+Reads the generate.py helper script written by run_image_tests.py, sleeps to simulate rendering
+and writes a small PFM image into the frame capture output directory. The image only depends on
+the test script, so results match references generated with the mock. Like image_tests/helpers.py,
+it records the startup, scene load and frame times in timings.json, half of the time is spent on
+loading and half on rendering 4 frames.
+
+Environment variables:
+  MOCK_MOGWAI_DURATION   Mean render time in seconds (default 1.0), varied per test by up to +-50%.
+  MOCK_MOGWAI_FAIL       Regular expression, tests whose script path matches exit with an error.
+  MOCK_MOGWAI_SLOW       Regular expression, tests whose script path matches render twice as slow.
+'''
+
+import os
+import re
+import sys
+import time
+import json
+import struct
+import zlib
+import argparse
+
+def write_pfm(path, width, height, color):
+    '''
+    Write an RGB PFM image filled with color.
+    '''
+    with open(path, 'wb') as f:
+        f.write(f'PF\n{width} {height}\n-1.0\n'.encode('ascii'))
+        f.write(struct.pack(f'<{width * height * 3}f', *(color * (width * height))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Mogwai for testing run_image_tests.py.')
+    parser.add_argument('--script', type=str, action='store', required=True)
+    parser.add_argument('--logfile', type=str, action='store')
+    parser.add_argument('--silent', action='store_true')
+    args, _ = parser.parse_known_args()
+
+    generate = open(args.script).read()
+    output_dir = re.search(r'outputDir = r"(.*)"', generate).group(1)
+    script_file = re.search(r'm\.script\(r"(.*)"\)', generate).group(1)
+
+    # Deterministic per-test variation of render time and image content.
+    h = zlib.crc32(script_file.replace('\\', '/').encode('utf-8'))
+    duration = float(os.environ.get('MOCK_MOGWAI_DURATION', '1.0')) * (0.5 + (h % 1000) / 1000)
+
+    if args.logfile:
+        with open(args.logfile, 'w') as f:
+            f.write(f'Mock Mogwai running {script_file} for {duration:.2f} s\n')
+
+    timings = {'script_start': time.time()}
+    if 'IMAGE_TEST_LAUNCH_TIME' in os.environ:
+        timings['startup'] = timings['script_start'] - float(os.environ['IMAGE_TEST_LAUNCH_TIME'])
+
+    time.sleep(duration / 2)
+    timings['scene_load'] = time.time() - timings['script_start']
+    slow = os.environ.get('MOCK_MOGWAI_SLOW', '')
+    frame_time = duration / 8 * (2 if slow and re.search(slow, script_file.replace('\\', '/')) else 1)
+    timings['frames'] = []
+    for _ in range(4):
+        start = time.time()
+        time.sleep(frame_time)
+        timings['frames'].append(time.time() - start)
+
+    fail = os.environ.get('MOCK_MOGWAI_FAIL', '')
+    if fail and re.search(fail, script_file.replace('\\', '/')):
+        print(f'Mock failure of {script_file}', file=sys.stderr)
+        sys.exit(1)
+
+    color = [((h >> shift) & 0xff) / 255 for shift in (0, 8, 16)]
+    write_pfm(os.path.join(output_dir, 'default.64.mock.pfm'), 4, 4, color)
+    with open(os.path.join(output_dir, 'timings.json'), 'w') as f:
+        json.dump(timings, f)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,16 @@ import datetime
 import argparse
 import subprocess
 import shutil
+import hashlib
+import statistics
 from pathlib import Path
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from build_falcor import build_falcor
 
-from core import Environment, helpers, config
+from core import Environment, helpers, config, image_compare, perf
+from core.result_cache import ResultCache
 from core.termcolor import colored
 
 
@@ -51,6 +55,15 @@ def read_header(script_file):
 
     return {}
 
+def mogwai_command(mogwai_exe):
+    '''
+    Return the command line prefix for running Mogwai.
+    Python scripts (e.g. mock_mogwai.py) are run with the current interpreter.
+    '''
+    if Path(mogwai_exe).suffix == '.py':
+        return [sys.executable, str(mogwai_exe)]
+    return [str(mogwai_exe)]
+
 class Test:
     '''
     Represents a single image test.
@@ -60,17 +73,23 @@ class Test:
         PASSED = 1
         FAILED = 2
         SKIPPED = 3
+        CACHED = 4
+        PERF_REGRESSION = 5
 
     COLORED_RESULT_STRING = {
         Result.PASSED: colored('PASSED', 'green'),
         Result.FAILED: colored('FAILED', 'red'),
-        Result.SKIPPED: colored('SKIPPED', 'yellow')
+        Result.SKIPPED: colored('SKIPPED', 'yellow'),
+        Result.CACHED: colored('CACHED', 'cyan'),
+        Result.PERF_REGRESSION: colored('PERF_REGRESSION', 'magenta')
     }
 
     RESULT_STRING = {
         Result.PASSED: 'PASSED',
         Result.FAILED: 'FAILED',
-        Result.SKIPPED: 'SKIPPED'
+        Result.SKIPPED: 'SKIPPED',
+        Result.CACHED: 'CACHED',
+        Result.PERF_REGRESSION: 'PERF_REGRESSION'
     }
 
     def __init__(self, script_file, root_dir):
@@ -102,6 +121,9 @@ class Test:
         # Get timeout.
         self.timeout = self.header.get('timeout', config.DEFAULT_TIMEOUT)
 
+        # Get performance tolerance, None to use the tolerance of the run.
+        self.perf_tolerance = self.header.get('perf_tolerance', None)
+
     def __repr__(self):
         return f'Test(name={self.name},script_file={self.script_file})'
 
@@ -147,19 +169,24 @@ class Test:
         relative_to_cwd = lambda p: os.path.relpath(p, cwd)
 
         # Write helper script to run test.
+        # It starts the timings file with the Mogwai startup time, render_frames() adds the frame times to it.
         generate_file = output_dir / 'generate.py'
+        timings_file = output_dir / perf.TIMINGS_FILE
+        timings_file.unlink(missing_ok=True)
         with open(generate_file, 'w') as f:
             f.write(f'm.frameCapture.outputDir = r"{output_dir}"\n')
+            f.write('import os, json, time\n')
+            f.write(f'with open(r"{timings_file}", "w") as f: json.dump({{"startup": time.time() - float(os.environ["IMAGE_TEST_LAUNCH_TIME"]), "script_start": time.time()}}, f)\n')
             f.write(f'm.script(r"{relative_to_cwd(self.script_file)}")\n')
 
         # Run Mogwai to generate images.
-        args = [
-            str(mogwai_exe),
+        args = mogwai_command(mogwai_exe) + [
             '--script', str(relative_to_cwd(generate_file)),
             '--logfile', str(output_dir / 'log.txt'),
             '--silent'
         ]
-        p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        env = dict(os.environ, IMAGE_TEST_LAUNCH_TIME=repr(time.time()))
+        p = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         try:
             outs, errs = p.communicate(timeout=self.timeout)
         except subprocess.TimeoutExpired:
@@ -178,11 +205,13 @@ class Test:
 
         return Test.Result.PASSED, []
 
-    def compare_image(self, ref_file, result_file, error_file, tolerance, image_compare_exe):
+    def compare_image(self, ref_file, result_file, error_file, tolerance, image_compare_exe, in_process=True):
         '''
-        Compare two images using ImageCompare.
+        Compare two images in-process, or using ImageCompare if in_process is False or the format is not supported.
         Returns a tuple containing the a boolean to indicate success and the measured error.
         '''
+        if in_process and ref_file.suffix.lower() in image_compare.SUPPORTED_EXTENSIONS:
+            return image_compare.compare_images(ref_file, result_file, 'mse', tolerance, heat_map_file=error_file)
         args = [str(image_compare_exe), '-m', 'mse', '-t', str(tolerance), str(ref_file), str(result_file)]
         if error_file:
             args += ['-e', str(error_file)]
@@ -191,9 +220,9 @@ class Test:
         error = float(output.strip())
         return process.returncode == 0, error
 
-    def compare_images(self, ref_dir, result_dir, image_compare_exe):
+    def compare_images(self, ref_dir, result_dir, image_compare_exe, in_process=True):
         '''
-        Run ImageCompare on a set of images in ref_dir and result_dir.
+        Compare a set of images in ref_dir and result_dir on a thread pool.
         Checks if error between reference and result image is within a given tolerance.
         Returns a tuple containing the result code, a list of messages and a list of image reports.
         '''
@@ -223,17 +252,22 @@ class Test:
         messages = []
         image_reports = []
 
-        # Compare every result image with the corresponding reference image and report missing references.
+        # Report missing references.
         for image in result_images:
             if not image in ref_images:
                 result = Test.Result.FAILED
                 messages.append(f'Test has generated image "{image}" with no corresponding reference image.')
-                continue
 
-            ref_file = ref_dir / image
-            result_file = result_dir / image
+        # Compare every result image with the corresponding reference image.
+        def compare(image):
             error_file = result_dir / (str(image) + config.ERROR_IMAGE_SUFFIX)
-            compare_success, compare_error = self.compare_image(ref_file, result_file, error_file, self.tolerance, image_compare_exe)
+            return self.compare_image(ref_dir / image, result_dir / image, error_file, self.tolerance, image_compare_exe, in_process)
+
+        images = [image for image in result_images if image in ref_images]
+        with ThreadPoolExecutor(max_workers=config.IMAGE_COMPARE_WORKERS) as executor:
+            compare_results = list(executor.map(compare, images))
+
+        for image, (compare_success, compare_error) in zip(images, compare_results):
             if not compare_success:
                 result = Test.Result.FAILED
                 messages.append(f'Test image "{image}" failed with error {compare_error}.')
@@ -253,21 +287,35 @@ class Test:
 
         return result, messages, image_reports
 
-    def run(self, compare_only, ref_dir, result_dir, mogwai_exe, image_compare_exe):
+    def run(self, compare_only, ref_dir, result_dir, mogwai_exe, image_compare_exe, in_process_compare=True, cache=None, perf_baseline=None, perf_tolerance=None, jobs=1):
         '''
         Run the image test.
-        First, result images are generated (unless compare_only is True).
+        If a cache is given and the test passed before with the same cache key, the previous result is reused.
+        First, result images are generated (unless compare_only is True) and their timings are recorded.
         Second, result images are compared against reference images.
-        Third, writes a JSON report to the result_dir containing details on the test run.
+        Third, if the images match, timings are compared against the report in the perf_baseline result directory,
+        unless the baseline ran with a different number of jobs.
+        Finally, writes a JSON report to the result_dir containing details on the test run.
         Returns a tuple containing the result code and a list of messages.
         '''
+        # Reuse the previous result if nothing affecting the test has changed.
+        cache_key = None
+        if cache and not compare_only and not self.skipped:
+            cache_key = cache.key(self, ref_dir)
+            if cache.lookup(self, cache_key):
+                return Test.Result.CACHED, []
+
         # Setup report.
         report = {
             'name': self.name,
             'ref_dir': str(ref_dir / self.test_dir),
+            'jobs': jobs,
             'images': []
         }
 
+        # Load baseline timings before the report is replaced, the baseline may be the previous run in result_dir.
+        baseline = perf.load_baseline(perf_baseline / self.test_dir, jobs) if perf_baseline else None
+
         start_time = time.time()
         result = Test.Result.PASSED
         messages = []
@@ -275,15 +323,33 @@ class Test:
         # Generate results images.
         if not compare_only:
             result, messages = self.generate_images(result_dir, mogwai_exe)
+            if result == Test.Result.PASSED:
+                report['timings'] = perf.load_timings(result_dir / self.test_dir, time.time() - start_time)
 
         # Compare to references.
         if result == Test.Result.PASSED:
-            result, messages, report['images'] = self.compare_images(ref_dir, result_dir, image_compare_exe)
+            result, messages, report['images'] = self.compare_images(ref_dir, result_dir, image_compare_exe, in_process_compare)
+
+        # Compare timings to the baseline.
+        if result == Test.Result.PASSED and baseline and 'timings' in report:
+            tolerance = self.perf_tolerance if self.perf_tolerance is not None else perf_tolerance if perf_tolerance is not None else config.DEFAULT_PERF_TOLERANCE
+            regressions = perf.compare_timings(report['timings'], baseline, tolerance)
+            report['perf'] = {
+                'baseline': str(perf_baseline / self.test_dir),
+                'baseline_timings': baseline,
+                'tolerance': tolerance,
+                'regressions': regressions
+            }
+            if regressions:
+                result = Test.Result.PERF_REGRESSION
+                messages = [perf.format_regression(r) for r in regressions]
 
         # Finish report.
         report['result'] = Test.RESULT_STRING[result]
         report['messages'] = messages
         report['duration'] = time.time() - start_time
+        if cache_key:
+            report['cache_key'] = cache_key
 
         # Write JSON report.
         report_dir = result_dir / self.test_dir
@@ -294,78 +360,136 @@ class Test:
 
         return result, messages
 
-def generate_refs(env, tests, ref_dir):
+def load_durations(tests, result_dir):
+    '''
+    Load the durations of tests from the reports of a previous run stored in result_dir.
+    Returns a dictionary mapping test names to durations in seconds.
+    '''
+    durations = {}
+    for test in tests:
+        report_file = result_dir / test.test_dir / 'report.json'
+        try:
+            with open(report_file) as f:
+                durations[test.name] = float(json.load(f)['duration'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return durations
+
+def schedule(tests, func, jobs, durations):
+    '''
+    Run func(test) for a set of tests on a pool of jobs workers, a single worker runs them one after another.
+    Tests are started longest expected duration first, tests without a previous duration go first.
+    Yields tuples containing the test, the result of func and the elapsed time as tests complete.
+    '''
+    def timed(test):
+        start_time = time.time()
+        return func(test), time.time() - start_time
+
+    tests = sorted(tests, key=lambda t: -durations.get(t.name, float('inf')))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(timed, test): test for test in tests}
+        for future in as_completed(futures):
+            result, elapsed_time = future.result()
+            yield futures[future], result, elapsed_time
+
+def print_result(test, result, messages, elapsed_time):
+    '''
+    Print the result and messages of a completed test.
+    '''
+    status = Test.COLORED_RESULT_STRING[result]
+    lines = [f'  {test.name:<60} : {status} ({elapsed_time:.1f} s)'] + [f'    {message}' for message in messages]
+    print('\n'.join(lines), flush=True)
+
+def generate_refs(env, tests, ref_dir, jobs=1, durations={}, clean=True):
     '''
     Computes references for a set of tests and stores them into ref_dir.
+    With clean, all existing references are removed, otherwise only the ones of the given tests (e.g. of a shard).
     '''
     print(f'Reference directory: {ref_dir}')
     print(f'Generating references for {len(tests)} tests')
 
     # Remove existing references.
-    if ref_dir.exists():
+    if clean and ref_dir.exists():
         shutil.rmtree(ref_dir, ignore_errors=True)
+    elif not clean:
+        for test in tests:
+            shutil.rmtree(ref_dir / test.test_dir, ignore_errors=True)
 
     success = True
 
-    for test in tests:
-        print(f'  {test.name:<60} : ', end='', flush=True)
-
-        start_time = time.time()
-        result, messages = test.generate_images(ref_dir, env.mogwai_exe)
-        elapsed_time = time.time() - start_time
-
+    generate = lambda t: t.generate_images(ref_dir, env.mogwai_exe)
+    for test, (result, messages), elapsed_time in schedule(tests, generate, jobs, durations):
         if result == Test.Result.FAILED:
             success = False
-
-        # Print result and messages.
-        status = Test.COLORED_RESULT_STRING[result]
-        print(f'{status} ({elapsed_time:.1f} s)')
-        for message in messages:
-            print(f'    {message}')
+        print_result(test, result, messages, elapsed_time)
 
     status = colored('PASSED', 'green') if success else colored('FAILED', 'red')
     print(f'\nGenerating references {status}.')
 
     return success
 
-def run_tests(env, tests, compare_only, ref_dir, result_dir):
+def data_dirs(env):
+    '''
+    Return the directories Mogwai searches for scenes and assets.
+    '''
+    dirs = [env.build_dir / 'Data', env.project_dir / 'Media']
+    dirs += [Path(d) for d in os.environ.get('FALCOR_MEDIA_FOLDERS', '').split(';') if d]
+    return dirs
+
+def run_tests(env, tests, compare_only, ref_dir, result_dir, jobs=1, durations={}, in_process_compare=True, use_cache=True, shard=None, perf_baseline=None, perf_tolerance=None):
     '''
     Runs a set of tests, stores them into result_dir and compares them to ref_dir.
+    Tests run on jobs workers in separate Mogwai processes and results are printed as they complete.
+    With use_cache, tests whose scripts, assets, binaries and references are unchanged since they last passed are not run again.
+    shard describes the partition when tests is one shard of a larger set, it is stored in the run report for merge_reports.
+    With a perf_baseline result directory, tests whose timings regressed by more than perf_tolerance are flagged with PERF_REGRESSION.
     '''
     print(f'Result directory: {result_dir}')
     print(f'Reference directory: {ref_dir}')
-    print(f'Running {len(tests)} tests')
+    if perf_baseline:
+        print(f'Performance baseline: {perf_baseline}')
+    print(f'Running {len(tests)} tests' + (f' on {jobs} workers' if jobs > 1 else ''))
 
     success = True
     run_date = datetime.datetime.now()
     run_start_time = time.time()
+    perf_regressions = []
 
-    for test in tests:
-        print(f'  {test.name:<60} : ', end='', flush=True)
-
-        start_time = time.time()
-        result, messages = test.run(compare_only, ref_dir, result_dir, env.mogwai_exe, env.image_compare_exe)
-        elapsed_time = time.time() - start_time
+    cache = None
+    if not compare_only:
+        cache = ResultCache(result_dir, data_dirs(env), reuse=use_cache)
+        cache.hash_binaries(env.build_dir, env.mogwai_exe)
 
-        if result == Test.Result.FAILED:
+    run = lambda t: t.run(compare_only, ref_dir, result_dir, env.mogwai_exe, env.image_compare_exe, in_process_compare, cache, perf_baseline, perf_tolerance, jobs)
+    for test, (result, messages), elapsed_time in schedule(tests, run, jobs, durations):
+        if result in [Test.Result.FAILED, Test.Result.PERF_REGRESSION]:
             success = False
-
-        # Print result and messages.
-        status = Test.COLORED_RESULT_STRING[result]
-        print(f'{status} ({elapsed_time:.1f} s)')
-        for message in messages:
-            print(f'    {message}')
+        if result == Test.Result.PERF_REGRESSION:
+            perf_regressions.append(test.name)
+        print_result(test, result, messages, elapsed_time)
 
     status = colored('PASSED', 'green') if success else colored('FAILED', 'red')
     print(f'\nImage tests {status}.')
+    if cache:
+        cache.save()
+        if cache.reuse:
+            print(f'Result cache: {cache.hits} cached, {cache.misses} run')
+    if perf_regressions:
+        print(f'Performance regressions: {len(perf_regressions)} tests')
 
     # Setup report.
     report = {
         'date': run_date.isoformat(),
         'result': 'PASSED' if success else 'FAILED',
         'tests': [t.name for t in tests],
-        'duration': time.time() - run_start_time
+        'duration': time.time() - run_start_time,
+        'jobs': jobs,
+        'cache': cache.stats() if cache else {'enabled': False}
     }
+    if perf_baseline:
+        report['perf'] = {'baseline': str(perf_baseline), 'regressions': sorted(perf_regressions)}
+    if shard:
+        report['shard'] = shard
 
     # Write JSON report.
     report_file = result_dir / 'report.json'
@@ -404,6 +528,146 @@ def collect_tests(root_dir, filter_regex, tags):
 
     return tests
 
+def parse_shard(shard):
+    '''
+    Parse a shard specification "i/N" into a tuple containing the 0-based index and the count.
+    '''
+    m = re.match(r'^(\d+)/(\d+)$', shard)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise ValueError(f'Invalid shard "{shard}", expected i/N with 1 <= i <= N.')
+    return int(m.group(1)) - 1, int(m.group(2))
+
+def partition_tests(tests, count, durations):
+    '''
+    Partition tests into count shards balanced by expected duration.
+    Tests are assigned longest first to the shard with the smallest total, ties broken by name and shard index,
+    so every machine computes the same partition from the same tests and durations.
+    Tests without a known duration are weighted by the median known duration, or by their timeout if none is known.
+    Returns a list of count lists of tests.
+    '''
+    known = [durations[t.name] for t in tests if t.name in durations]
+    default = statistics.median(known) if known else None
+    weight = lambda t: durations.get(t.name, default if default is not None else t.timeout)
+
+    shards = [[] for _ in range(count)]
+    totals = [0.0] * count
+    for test in sorted(tests, key=lambda t: (-weight(t), t.name)):
+        i = min(range(count), key=lambda i: (totals[i], i))
+        shards[i].append(test)
+        totals[i] += weight(test)
+    return shards
+
+def shard_tests(tests, shard, durations):
+    '''
+    Select the tests of a shard "i/N".
+    Returns a tuple containing the tests in their original order and a description of the shard for the run report.
+    '''
+    index, count = parse_shard(shard)
+    shards = partition_tests(tests, count, durations)
+    selected = set(t.name for t in shards[index])
+    # All shards of one partition share its digest, merge_reports uses it to detect mismatching partitions.
+    digest = hashlib.sha256(json.dumps([[t.name for t in s] for s in shards]).encode('utf-8')).hexdigest()
+    info = {
+        'index': index,
+        'count': count,
+        'partition': digest,
+        'total_tests': len(tests)
+    }
+    return [t for t in tests if t.name in selected], info
+
+def merge_reports(shard_dirs, result_dir):
+    '''
+    Merge the result directories of the shards of a run into result_dir.
+    Test results are copied, and a run report covering all tests is written which fails if any shard
+    failed, is missing or used a different partition.
+    '''
+    print(f'Result directory: {result_dir}')
+    print(f'Merging {len(shard_dirs)} shards')
+
+    runs = []
+    for shard_dir in shard_dirs:
+        try:
+            with open(shard_dir / 'report.json') as f:
+                runs.append((shard_dir, json.load(f)))
+        except (OSError, ValueError) as e:
+            print(colored(f'  Cannot read run report of "{shard_dir}" ({e}).', 'red'))
+            return False
+
+    success = True
+    messages = []
+    tests = []
+    for shard_dir, run in runs:
+        print(f'  {str(shard_dir):<60} : {run["result"]} ({len(run["tests"])} tests, {run["duration"]:.1f} s)')
+        if run['result'] != 'PASSED':
+            success = False
+        for name in run['tests']:
+            if name in tests:
+                success = False
+                messages.append(f'Test "{name}" ran in more than one shard.')
+            else:
+                tests.append(name)
+            # Copy test results unless merging in place.
+            src_dir = shard_dir / name
+            dst_dir = result_dir / name
+            if src_dir.exists() and src_dir.resolve() != dst_dir.resolve():
+                shutil.copytree(src_dir, dst_dir, dirs_exist_ok=True)
+
+    # Check that the shards form one complete partition.
+    shards = [run.get('shard') for _, run in runs]
+    if all(shards):
+        count = shards[0]['count']
+        if any(s['partition'] != shards[0]['partition'] or s['count'] != count for s in shards):
+            success = False
+            messages.append('Shards were partitioned differently, use the same tests and durations on all machines.')
+        missing = sorted(set(range(count)) - set(s['index'] for s in shards))
+        if missing:
+            success = False
+            messages.append(f'Missing shards: {", ".join(f"{i + 1}/{count}" for i in missing)}.')
+        if len(tests) != shards[0]['total_tests']:
+            success = False
+            messages.append(f'Merged {len(tests)} of {shards[0]["total_tests"]} tests.')
+    else:
+        messages.append('Some runs have no shard information, completeness is not checked.')
+
+    for message in messages:
+        print(f'    {message}')
+
+    # Merge cache statistics.
+    caches = [run.get('cache', {}) for _, run in runs]
+    cache = {
+        'enabled': any(c.get('enabled', False) for c in caches),
+        'hits': sum(c.get('hits', 0) for c in caches),
+        'misses': sum(c.get('misses', 0) for c in caches),
+        'tests': sorted(t for c in caches for t in c.get('tests', []))
+    }
+
+    # Merge performance regressions.
+    perfs = [run['perf'] for _, run in runs if 'perf' in run]
+
+    # Setup report, shards run concurrently so the run takes as long as the slowest one.
+    report = {
+        'date': min(run['date'] for _, run in runs),
+        'result': 'PASSED' if success else 'FAILED',
+        'tests': tests,
+        'duration': max(run['duration'] for _, run in runs),
+        'cache': cache,
+        'shards': [dict(run.get('shard', {}), dir=str(shard_dir), result=run['result'], duration=run['duration'], jobs=run.get('jobs')) for shard_dir, run in runs],
+        'messages': messages
+    }
+    if perfs:
+        report['perf'] = {'baseline': perfs[0]['baseline'], 'regressions': sorted(t for p in perfs for t in p['regressions'])}
+
+    # Write JSON report.
+    result_dir.mkdir(parents=True, exist_ok=True)
+    report_file = result_dir / 'report.json'
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    status = colored('PASSED', 'green') if success else colored('FAILED', 'red')
+    print(f'\nMerged image tests {status}.')
+
+    return success
+
 def push_refs(ref_dir, remote_ref_dir):
     '''
     Pushes reference images from ref_dir to remote_ref_dir.
@@ -438,6 +702,15 @@ def main():
     parser.add_argument('--compare-only', action='store_true', help='Compare previous results against references without generating new images')
     parser.add_argument('--gen-refs', action='store_true', help='Generate reference images instead of running tests')
     parser.add_argument('--skip-build', action='store_true', help='Skip building project before running')
+    parser.add_argument('-j', '--jobs', type=int, action='store', help='Number of tests to run concurrently, longest first based on the previous run', default=1)
+    parser.add_argument('--no-cache', action='store_true', help='Run all tests even if their result is cached from a previous run')
+    parser.add_argument('--image-compare', choices=['python', 'exe'], help='Compare images in-process or with ImageCompare', default='python')
+    parser.add_argument('--shard', type=str, action='store', help='Run shard i/N of the tests, balanced by the durations in --shard-durations')
+    parser.add_argument('--shard-durations', type=str, action='store', help='Result directory with the durations to balance shards by, must be the same on all machines (shards are balanced by test timeouts without it)')
+    parser.add_argument('--merge-reports', type=str, nargs='+', metavar='SHARD_DIR', help='Merge the result directories of shards into the result directory')
+    parser.add_argument('--perf-baseline', type=str, action='store', help='Result directory of a previous run to compare test timings against, slower tests are flagged with PERF_REGRESSION (requires -j 1)')
+    parser.add_argument('--perf-tolerance', type=float, action='store', help=f'Relative slowdown against the performance baseline that is tolerated (default {config.DEFAULT_PERF_TOLERANCE}), tests can override it with "perf_tolerance"')
+    parser.add_argument('--mogwai', type=str, action='store', help='Mogwai executable to use instead of the built one, e.g., testing/mock_mogwai.py')
 
     additional_group = parser.add_argument_group('extended arguments ', 'Additional options used for testing pipelines on TeamCity.')
     additional_group.add_argument('--pull-refs', action='store_true', help='Pull reference images from remote before running tests')
@@ -453,8 +726,18 @@ def main():
         print(e)
         sys.exit(1)
 
+    if args.mogwai:
+        env.mogwai_exe = Path(args.mogwai).resolve()
+
+    # Merge results of shards, nothing needs to be built or run.
+    if args.merge_reports:
+        result_dir = env.resolve_image_dir(env.image_tests_result_dir, env.branch, args.build_id)
+        if not merge_reports([Path(d).resolve() for d in args.merge_reports], result_dir):
+            sys.exit(1)
+        sys.exit(0)
+
     # Build solution before running tests.
-    if not (args.skip_build or args.list):
+    if not (args.skip_build or args.list or args.mogwai):
         if not build_falcor(env):
             print('Build failed. Not running tests.')
             sys.exit(1)
@@ -462,13 +745,26 @@ def main():
     # Collect tests to run.
     tests = collect_tests(env.image_tests_dir, args.filter, args.tags)
 
+    # Select the tests of this machine.
+    shard = None
+    if args.shard:
+        # Durations must come from the same directory on all machines, otherwise their partitions differ.
+        durations = load_durations(tests, Path(args.shard_durations).resolve()) if args.shard_durations else {}
+        try:
+            tests, shard = shard_tests(tests, args.shard, durations)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(f'Shard {args.shard}: {len(tests)} of {shard["total_tests"]} tests')
+
     if args.list:
         # List available tests.
         list_tests(tests)
     elif args.gen_refs:
         # Generate references.
         ref_dir = env.resolve_image_dir(env.image_tests_ref_dir, env.branch, args.build_id)
-        if not generate_refs(env, tests, ref_dir):
+        result_dir = env.resolve_image_dir(env.image_tests_result_dir, env.branch, args.build_id)
+        if not generate_refs(env, tests, ref_dir, args.jobs, load_durations(tests, result_dir), clean=shard is None):
             sys.exit(1)
 
         # Push references to remote.
@@ -511,7 +807,12 @@ def main():
             sys.exit(1)
 
         # Run tests.
-        if not run_tests(env, tests, args.compare_only, ref_dir, result_dir):
+        perf_baseline = Path(args.perf_baseline).resolve() if args.perf_baseline else None
+        if perf_baseline and args.jobs > 1:
+            # Concurrent tests slow each other down, their timings cannot be compared.
+            print('Cannot compare timings with --perf-baseline when running tests concurrently, use -j 1.')
+            sys.exit(1)
+        if not run_tests(env, tests, args.compare_only, ref_dir, result_dir, args.jobs, load_durations(tests, result_dir), args.image_compare == 'python', not args.no_cache, shard, perf_baseline, args.perf_tolerance):
             sys.exit(1)
 
     sys.exit(0)
@@ -15,7 +15,7 @@ from pathlib import Path
 import libs.bottle as bottle
 from libs.bottle import route, view, request, run, template, static_file
 
-from core import Environment, config, helpers
+from core import Environment, config, helpers, perf
 
 # Directory containing viewer files.
 VIEWER_DIR = Path(__file__).parent / 'viewer'
@@ -129,9 +129,13 @@ class Database:
         if load_tests:
             tests = []
 
+            # Tests reused from a previous run keep their report, the run lists them as cached.
+            cached = set(run.get('cache', {}).get('tests', []))
             for test_report_file in (self.result_dir / run_dir).glob('*/**/report.json'):
                 test = self.load_test(test_report_file, load_log=False)
                 if test:
+                    if test['name'] in cached:
+                        test['result'] = 'CACHED'
                     tests.append(test)
 
             run['tests'] = tests
@@ -153,6 +157,30 @@ class Database:
 
         return test
 
+    def load_test_history(self, test_dir):
+        '''
+        Load the timings of a test from all runs, sorted by date.
+        '''
+        history = []
+
+        for run_report_file in self.result_dir.glob(self.run_glob):
+            run = self.load_run(run_report_file, load_tests=False)
+            if not run:
+                continue
+            test = self.load_test(self.test_report_file(run['run_dir'], test_dir), load_log=False)
+            if test and 'timings' in test:
+                history.append({
+                    'run_dir': run['run_dir'],
+                    'date': run['date'],
+                    'result': test['result'],
+                    'timings': test['timings']
+                })
+
+        # Sort by date.
+        history.sort(key=lambda h: h['date'])
+
+        return history
+
 
 def load_json(path):
     '''
@@ -172,7 +200,7 @@ def run_stats(run):
     if total_count == 0:
         return []
     stats = []
-    for result, color in zip(['PASSED', 'SKIPPED', 'FAILED'], ['#32b643', '#ffb700', '#e85600']):
+    for result, color in zip(['PASSED', 'CACHED', 'SKIPPED', 'PERF_REGRESSION', 'FAILED'], ['#32b643', '#5755d9', '#ffb700', '#b8008a', '#e85600']):
         count = len(list(filter(lambda test: test['result'] == result, run['tests'])))
         stats.append({
             'title': result,
@@ -198,6 +226,58 @@ def test_stats(test):
         })
     return stats
 
+def timing_rows(test):
+    '''
+    Compute the rows of the timings table of a test, comparing against the baseline if there is one.
+    '''
+    baseline = perf.flatten_timings(test['perf']['baseline_timings']) if 'perf' in test else {}
+    regressed = set(r['metric'] for r in test.get('perf', {}).get('regressions', []))
+    rows = []
+    for metric, value in perf.flatten_timings(test['timings']).items():
+        base = baseline.get(metric)
+        rows.append({
+            'metric': metric,
+            'value': perf.format_time(value),
+            'baseline': perf.format_time(base) if base else '',
+            'change': f'{value / base - 1:+.1%}' if base else '',
+            'regressed': metric in regressed
+        })
+    return rows
+
+def timing_charts(history, width=640, height=120, margin=8):
+    '''
+    Compute line charts of the timings of a test across runs, one chart per metric.
+    '''
+    series = {}
+    for i, entry in enumerate(history):
+        for metric, value in perf.flatten_timings(entry['timings']).items():
+            series.setdefault(metric, []).append((i, value, entry))
+
+    charts = []
+    for metric, values in series.items():
+        max_value = max(v for _, v, _ in values) * 1.1
+        if max_value <= 0:
+            continue
+        x = lambda i: margin + (width - 2 * margin) * (i / max(1, len(history) - 1))
+        y = lambda v: height - margin - (height - 2 * margin) * v / max_value
+        points = [{
+            'x': round(x(i), 1),
+            'y': round(y(v), 1),
+            'title': f'{format_date(entry["date"])}: {perf.format_time(v)}',
+            'link': '/' + entry['run_dir'],
+            'color': '#b8008a' if entry['result'] == 'PERF_REGRESSION' else '#5755d9'
+        } for i, v, entry in values]
+        charts.append({
+            'metric': metric,
+            'width': width,
+            'height': height,
+            'axis': height - margin,
+            'max': perf.format_time(max_value),
+            'points': points,
+            'polyline': ' '.join(f'{p["x"]},{p["y"]}' for p in points)
+        })
+    return charts
+
 def create_jeri_data(result_image, ref_image, error_image, extra_metrics=['L1', 'L2', 'MAPE', 'MRSE', 'SMAPE', 'SSIM']):
     '''
     Create a jeri config object for comparing two images.
@@ -374,6 +454,8 @@ def catch_all(path):
             ]
             stats = test_stats(test)
             ref_dir = str(Path(test['ref_dir']).relative_to(database.ref_dir).as_posix())
+            timings = timing_rows(test) if 'timings' in test else []
+            charts = timing_charts(database.load_test_history(test_dir)) if 'timings' in test else []
             return template(
                 'test',
                 nav=nav,
@@ -382,6 +464,8 @@ def catch_all(path):
                 test_dir=test_dir,
                 ref_dir=ref_dir,
                 test=test,
+                timings=timings,
+                charts=charts,
                 format_duration=format_duration
             )
     else:
@@ -5,6 +5,8 @@
 <span class="label label-error">FAILED</span>
 % elif result == 'SKIPPED':
 <span class="label label-warning">SKIPPED</span>
+% elif result == 'PERF_REGRESSION':
+<span class="label label-perf">PERF_REGRESSION</span>
 % else:
 <span class="label">{{result}}</span>
 % end
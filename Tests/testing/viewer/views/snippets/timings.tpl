@@ -0,0 +1,44 @@
+% if perf:
+<p>Baseline: {{perf['baseline']}} (tolerance {{'{:.0%}'.format(perf['tolerance'])}})</p>
+% end
+<table class="table table-striped">
+    <thead>
+        <tr>
+            <th>Timing</th>
+            <th>Time</th>
+            <th>Baseline</th>
+            <th>Change</th>
+        </tr>
+    </thead>
+    <tbody>
+    % for row in timings:
+        <tr>
+            <td>{{row['metric']}}</td>
+            <td>{{row['value']}}</td>
+            <td>{{row['baseline']}}</td>
+            <td>
+                % if row['regressed']:
+                <span class="label label-perf">{{row['change']}}</span>
+                % else:
+                {{row['change']}}
+                % end
+            </td>
+        </tr>
+    % end
+    </tbody>
+</table>
+
+% for chart in charts:
+<div class="chart">
+    <h6>{{chart['metric']}} <small class="text-gray">(max {{chart['max']}})</small></h6>
+    <svg width="{{chart['width']}}" height="{{chart['height']}}">
+        <line class="chart-axis" x1="0" y1="{{chart['axis']}}" x2="{{chart['width']}}" y2="{{chart['axis']}}"/>
+        <polyline class="chart-line" points="{{chart['polyline']}}"/>
+        % for point in chart['points']:
+        <a href="{{point['link']}}">
+            <circle cx="{{point['x']}}" cy="{{point['y']}}" r="3" fill="{{point['color']}}"><title>{{point['title']}}</title></circle>
+        </a>
+        % end
+    </svg>
+</div>
+% end
@@ -52,6 +52,12 @@
 </table>
 % end
 
+% if len(timings) > 0:
+<div class="divider"></div>
+<h5>Timings</h5>
+% include('snippets/timings', timings=timings, charts=charts, perf=test.get('perf'))
+% end
+
 % if test['messages'] != []:
 <div class="divider"></div>
 <h5>Messages</h5>
@@ -1,4 +1,5 @@
 import os
+import json
 import subprocess
 import queue
 import threading
@@ -13,6 +14,8 @@ import argparse
 import glob
 
 import scripts.exr as exr
+from scripts.manifest import MANIFEST_NAME, Manifest
+from scripts.dataset import PACKED_NAME
 import config
 
 class RobocopyManager:
@@ -35,82 +38,177 @@ class RobocopyManager:
             print(f'Completed robocopy from {source} to {destination}')
             self.queue.task_done()
 
-# Function to update the variable value
-def update_variable(match, new_value):
-    if match:
-        variable, value, _, _ = match.groups()
-
-        # Check if the original value is a string
-        if value.startswith('"') or value.startswith("'"):
-            return f'{variable} = "{new_value}"'
-        else:
-            return f'{variable} = {new_value}'
+def worker_count():
+    return max(1, min(60, mp.cpu_count() - 4)) # 60 is maximum for Windows
+
+class PostprocessPool:
+    """Long-lived worker pool shared by all post-processing steps.
+
+    Created once in __main__ so the workers (and their numpy/OpenEXR imports) are reused
+    across samples and scenes. `submit` returns immediately, which lets a step run while
+    Mogwai renders the next sample; `wait` blocks until everything submitted has finished.
+    """
+    def __init__(self, processes=None):
+        self.pool = mp.Pool(processes=processes or worker_count())
+        self.pending = []
+
+    def submit(self, func, args):
+        """Queue func(*a) for every a in args."""
+        self.pending.append(self.pool.starmap_async(func, args))
+
+    def map(self, func, args):
+        """Run func(*a) for every a in args and wait for the results."""
+        self.submit(func, args)
+        self.wait()
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for task in pending:
+            task.get()
+
+    def close(self):
+        self.wait()
+        self.pool.close()
+        self.pool.join()
+
+# Per-process read buffers reused across frames, keyed by slot (see exr.InputFile.get's `out`).
+# The returned image is overwritten by the next read into the same slot.
+_read_buffers = {}
+
+def read_default(path, slot='default'):
+    f = exr.open(path)
+    shape = f.shape('default')
+    buf = _read_buffers.get(slot)
+    if buf is None or buf.shape != shape:
+        buf = _read_buffers[slot] = np.empty(shape, dtype=np.float32)
+    return f.get('default', out=buf)
+
+def buffer_name(filename):
+    # '0003_roughness2_0100.exr' -> 'roughness2', 'ref_current_0100_0042.exr' -> 'ref_current'
+    parts = os.path.splitext(os.path.basename(filename))[0].split('_')
+    return '_'.join(p for p in parts if not p.isdigit())
+
+def output_policy(filename):
+    name = buffer_name(filename)
+    policy = config.EXR_BUFFER_POLICY.get(name, config.EXR_BUFFER_POLICY.get(name.rstrip('0123456789'), {}))
+    return dict(config.EXR_DEFAULT_POLICY, **policy)
+
+def write_buffer(path, img, final=True):
+    # Write a post-processed buffer with its output policy from config.py
+    policy = output_policy(path)
+    if policy['channels'] is not None:
+        img = img[:,:,:policy['channels']]
+    if final:
+        compression = getattr(exr, f"{policy['compression']}_COMPRESSION")
+        precision = getattr(exr, policy['precision'])
     else:
-        print("doesn't match", match, new_value)
-
-def change_variable_code(code, varname, new_value):
-    pattern = rf'(^{varname})\s*=\s*((["\'])(?P<inside_quotes>.*?)\3|.+)$'
-    code = re.sub(pattern, lambda m: update_variable(m, new_value), code, flags=re.MULTILINE)
-    return code
-
-def change_scene(scene_name):
-    # the file we want to modify
-    filename = 'main.py'
-    # read the contents of the file into a string
-    with open(filename, 'r') as f:
-        code = f.read()
-
-    variables = ['NAME', 'FILE', 'ANIM']
-    values = [scene_name, scene.defs[scene_name]['file'], scene.defs[scene_name]['anim']]
-
-    for varname, val in zip(variables, values):
-        code = change_variable_code(code, varname, val)
-
-    # write the new code back to the file
-    with open(filename, 'w') as f:
-        f.write(code)
-
-def update_pyvariable(filename, varname, new_value):
-    assert(filename.endswith('.py'))
-
-    # read the contents of the file into a string
-    with open(filename, 'r') as f:
-        code = f.read()
-        code = change_variable_code(code, varname, new_value)
-
-    # write the new code back to the file
-    with open(filename, 'w') as f:
-        f.write(code)
-
-def change_method(new_method):
-    # the file we want to modify
-    filename = 'main.py'
-    # read the contents of the file into a string
-    with open(filename, 'r') as f:
-        code = f.read()
-
-    # use regular expressions to find the assignment statement for the METHOD variable
-    match = re.search(r'METHOD\s*=\s*["\'](.*)["\']', code)
-
-    if match:
-        # replace the old value with the new value
-        new_code = code[:match.start(1)] + new_method + code[match.end(1):]
-
-        # write the new code back to the file
-        with open(filename, 'w') as f:
-            f.write(new_code)
+        compression = getattr(exr, f'{config.EXR_INTERMEDIATE_COMPRESSION}_COMPRESSION')
+        precision = exr.FLOAT
+    exr.write(path, img, precision=precision, compression=compression)
+
+def read_stack(paths, slot='stack'):
+    # Read same-sized images into one (S, H, W, C) array, reused like `read_default`.
+    # Images which cannot be read are left out, so S may be less than len(paths).
+    shape = None
+    for path in paths:
+        try:
+            shape = (len(paths),) + exr.open(path).shape('default')
+            break
+        except Exception:
+            pass
+    if shape is None:
+        raise Exception(f'None of the {len(paths)} images could be read.')
+    buf = _read_buffers.get(slot)
+    if buf is None or buf.shape != shape:
+        buf = _read_buffers[slot] = np.empty(shape, dtype=np.float32)
+    # A few threads per worker process overlap disk reads and decoding
+    buf, errors = exr.read_many(paths, workers=min(len(paths), 4), stack=True, out=buf)
+    for path, e in errors.items():
+        print(f'WARN: Failed to read {path}: {str(e)}')
+    if errors:
+        # Failed rows are NaN, drop them before they reach an average
+        buf = buf[[i for i, path in enumerate(paths) if path not in errors]]
+        if len(buf) == 0:
+            raise Exception(f'None of the {len(paths)} images could be read.')
+    return buf
+
+def normalize(img):
+    factor = np.linalg.norm(img, axis=2, keepdims=True)
+    factor[factor == 0] = 1
+    img /= factor
+    return img
+
+def average_batch(src_dir, dest_dir, f, sample_idx):
+    # Keep the samples as rendered and reduce them at once after the last one
+    shutil.move(os.path.join(src_dir, f), os.path.join(dest_dir, f'{sample_idx:04d}_{f}'))
+    if sample_idx < config.SAMPLES_PER_PIXEL - 1:
+        return
+    paths = [os.path.join(dest_dir, f'{i:04d}_{f}') for i in range(config.SAMPLES_PER_PIXEL)]
+    paths = [path for path in paths if os.path.exists(path)]
+    if len(paths) < config.SAMPLES_PER_PIXEL:
+        print(f'WARN: {config.SAMPLES_PER_PIXEL - len(paths)} samples of {f} missing, averaging {len(paths)}.')
+    stack = read_stack(paths)
+    avg = stack.mean(axis=0)
+    if 'normal' in f: # Normalize normals
+        normalize(avg)
+    # The average replaces the last sample, the others are removed once it is written
+    out_path = os.path.join(dest_dir, f'{sample_idx:04d}_{f}')
+    write_buffer(out_path, avg)
+    for path in paths:
+        if path != out_path:
+            os.remove(path)
+
+def average_incremental(src_dir, dest_dir, f, sample_idx):
+    # Keep the running mean in an uncompressed float32 sidecar and encode the EXR after the last sample
+    sidecar = os.path.join(dest_dir, f'{os.path.splitext(f)[0]}.npy')
+    img = read_default(os.path.join(src_dir, f), 'sample')
+    if sample_idx == 0 or not os.path.exists(sidecar):
+        if sample_idx != 0:
+            print(f'WARN: {sidecar} not found, restarting the mean at sample {sample_idx}.')
+        avg = np.lib.format.open_memmap(sidecar, mode='w+', dtype=np.float32, shape=img.shape)
+        avg[...] = img
     else:
-        print('Could not find METHOD variable in file.')
+        avg = np.lib.format.open_memmap(sidecar, mode='r+')
+        avg *= sample_idx
+        avg += img
+        avg /= sample_idx + 1
+    os.remove(os.path.join(src_dir, f))
+    if sample_idx < config.SAMPLES_PER_PIXEL - 1:
+        avg.flush()
+        return
+    avg = np.array(avg)
+    if 'normal' in f: # Normalize normals
+        normalize(avg)
+    write_buffer(os.path.join(dest_dir, f'{sample_idx:04d}_{f}'), avg)
+    os.remove(sidecar)
+
+_manifests = {}
+
+def get_manifest(directory):
+    # Manifest of an output directory, kept by the main process across post-processing steps and
+    # brought up to date with one scan per call
+    key = os.path.abspath(directory)
+    if key in _manifests:
+        return _manifests[key].update()
+    _manifests[key] = Manifest(directory)
+    return _manifests[key]
+
+def drop_manifest(directory):
+    _manifests.pop(os.path.abspath(directory), None)
+    path = os.path.join(directory, MANIFEST_NAME)
+    if os.path.exists(path):
+        os.remove(path)
 
 def postprocess_common(src_dir, scene_name, frames):
     # Remove last frames, if does not exist, ignore it
     num_frames = scene.defs[scene_name]['anim'][1] - scene.defs[scene_name]['anim'][0] + 1
     if scene_name != "Dining-room-dynamic":
+        manifest = get_manifest(src_dir)
         for frame in range(frames[0] + num_frames, frames[0] + num_frames + 10):
-            for f in os.listdir(src_dir):
-                if f.endswith(f'{frame:04d}.exr'):
-                    if os.path.exists(os.path.join(src_dir, f)):
-                        os.remove(os.path.join(src_dir, f))
+            for f in manifest.files(frame=frame):
+                os.remove(os.path.join(src_dir, f))
+                manifest.remove(f)
+        manifest.save()
 
 def starts_with_number(filename):
     # This pattern matches any string that starts with exactly four digits
@@ -119,8 +217,11 @@ def starts_with_number(filename):
         return True
     return False
 
-def process_input(src_dir, dest_dir, frame, sample_idx, suffix=''):
+def process_input(src_dir, dest_dir, frame, files, sample_idx, suffix=''):
+    # `files` are the rendered files of the frame in src_dir
     try:
+        rendered_files = set(files)
+
         ### Post-process the indivisual images
         # # RGB to Z
         # names = ["visibility"]
@@ -134,14 +235,18 @@ def process_input(src_dir, dest_dir, frame, sample_idx, suffix=''):
         #         print(f'WARN: {path} not found.')
 
         # specRough and diffuseOpacity to roughness and opacity
+        # These are samples read back for averaging unless there is a single sample
+        final = config.SAMPLES_PER_PIXEL == 1
         spec_path = os.path.join(src_dir, f'specRough{suffix}_{frame:04d}.exr')
         if os.path.exists(spec_path):
-            spec_img = exr.read_all(spec_path)['default']
+            spec_img = read_default(spec_path, 'specRough')
             if spec_img.shape[-1] == 4:
                 rough_img = spec_img[:,:,3:4]
-                exr.write(os.path.join(dest_dir, f'roughness{suffix}_{frame:04d}.exr'), rough_img, compression=exr.ZIP_COMPRESSION)
-                exr.write(os.path.join(dest_dir, f'specularAlbedo{suffix}_{frame:04d}.exr'), spec_img[:,:,0:3], compression=exr.ZIP_COMPRESSION)
+                write_buffer(os.path.join(src_dir, f'roughness{suffix}_{frame:04d}.exr'), rough_img, final)
+                write_buffer(os.path.join(src_dir, f'specularAlbedo{suffix}_{frame:04d}.exr'), spec_img[:,:,0:3], final)
                 os.remove(os.path.join(src_dir, f'specRough{suffix}_{frame:04d}.exr'))
+                rendered_files.discard(f'specRough{suffix}_{frame:04d}.exr')
+                rendered_files |= {f'roughness{suffix}_{frame:04d}.exr', f'specularAlbedo{suffix}_{frame:04d}.exr'}
             else:
                 print(f"WARN: {spec_path} has no alpha channel.")
         else:
@@ -149,83 +254,125 @@ def process_input(src_dir, dest_dir, frame, sample_idx, suffix=''):
 
         diffuseOpacity_path = os.path.join(src_dir, f'diffuseOpacity{suffix}_{frame:04d}.exr')
         if os.path.exists(diffuseOpacity_path):
-            diffuseOpacity_img = exr.read_all(diffuseOpacity_path)['default']
+            diffuseOpacity_img = read_default(diffuseOpacity_path, 'diffuseOpacity')
             if diffuseOpacity_img.shape[-1] == 4:
                 diffuse_img = diffuseOpacity_img[:,:,0:3]
                 opacity_img = diffuseOpacity_img[:,:,3:4]
-                exr.write(os.path.join(dest_dir, f'diffuseAlbedo{suffix}_{frame:04d}.exr'), diffuse_img, compression=exr.ZIP_COMPRESSION)
-                exr.write(os.path.join(dest_dir, f'opacity{suffix}_{frame:04d}.exr'), opacity_img, compression=exr.ZIP_COMPRESSION)
+                write_buffer(os.path.join(src_dir, f'diffuseAlbedo{suffix}_{frame:04d}.exr'), diffuse_img, final)
+                write_buffer(os.path.join(src_dir, f'opacity{suffix}_{frame:04d}.exr'), opacity_img, final)
                 os.remove(os.path.join(src_dir, f'diffuseOpacity{suffix}_{frame:04d}.exr'))
+                rendered_files.discard(f'diffuseOpacity{suffix}_{frame:04d}.exr')
+                rendered_files |= {f'diffuseAlbedo{suffix}_{frame:04d}.exr', f'opacity{suffix}_{frame:04d}.exr'}
             else:
                 print(f"WARN: {diffuseOpacity_path} has no alpha channel.")
         else:
             print(f'WARN: {diffuseOpacity_path} not found.')
 
         ### Post-process to handle multi-samples
-        # Collect files of the currently rendered frame
-        rendered_files = os.listdir(dest_dir)
-        rendered_files = [f for f in rendered_files if f.endswith(f'{frame:04d}.exr')]
-        rendered_files = [f for f in rendered_files if not starts_with_number(f)]
-        rendered_files = [f for f in rendered_files if 'mvec' not in f]
-
-        # Find the largest sample index from {sample_idx:04d}_*.exr
-        if sample_idx == 0:
-            # Just move, e.g., albedo_0100.exr -> 0000_albedo_0100.exr
-            for f in rendered_files:
-                shutil.move(os.path.join(dest_dir, f), os.path.join(dest_dir, f'{sample_idx:04d}_{f}'))
-        else:
-            last_sample_idx = sample_idx - 1
-            # Average the images
-            for f in rendered_files:
-                img_avg = exr.read_all(os.path.join(dest_dir, f'{last_sample_idx:04d}_{f}'))['default']
-                img = exr.read_all(os.path.join(dest_dir, f))['default']
-                new_avg = ((last_sample_idx+1) * img_avg + img) / ((last_sample_idx+1) + 1)
-                if 'normal' in f: # Normalize normals
-                    factor = np.linalg.norm(new_avg, axis=2, keepdims=True)
-                    factor[factor == 0] = 1
-                    new_avg /= factor
-                exr.write(os.path.join(dest_dir, f'{sample_idx:04d}_{f}'), new_avg, compression=exr.ZIP_COMPRESSION)
-                os.remove(os.path.join(dest_dir, f))
-                os.remove(os.path.join(dest_dir, f'{last_sample_idx:04d}_{f}'))
+        # Files of the currently rendered frame
+        rendered_files = sorted(f for f in rendered_files if 'mvec' not in f)
+
+        # The average of all samples ends up in {last sample_idx:04d}_*.exr
+        for f in rendered_files:
+            if config.SAMPLES_PER_PIXEL == 1:
+                # Just move, e.g., albedo_0100.exr -> 0000_albedo_0100.exr
+                shutil.move(os.path.join(src_dir, f), os.path.join(dest_dir, f'{sample_idx:04d}_{f}'))
+            elif config.INPUT_AVERAGING == 'batch':
+                average_batch(src_dir, dest_dir, f, sample_idx)
+            else:
+                average_incremental(src_dir, dest_dir, f, sample_idx)
 
     except Exception as e:
         func_name = sys._getframe()
         line_number = sys.exc_info()[-1].tb_lineno
         print(f"[{func_name}, line {line_number}] Error processing frame {frame}: {str(e)}")
 
-def postprocess_input(src_dir, scene_name, frames, sample_idx, suffix=''):
+def postprocess_input(pool, src_dir, dest_dir, scene_name, frames, sample_idx, suffix='', rendered=None):
     print('\tPost-processing the input or secondinput...', end=' ', flush=True)
 
-    # Process multiprocessing
-    num_workers = min(60, mp.cpu_count() - 4) # 60 is maximum for Windows
-    with mp.Pool(processes=num_workers) as pool:
-        pool.starmap(process_input, [(src_dir, src_dir, frame, sample_idx, suffix) for frame in frames])
-    pool.close()
+    rendered = rendered or Manifest(src_dir, persist=False)
+    pool.map(process_input, [(src_dir, dest_dir, frame, rendered.files(frame=frame, prefixed=False), sample_idx, suffix) for frame in frames])
 
     print('Done')
 
 def postprocess_ref(src_dir, scene_name, frames):
     pass
 
+class RunningMean:
+    """Running float64 sum of the ref_restir samples of one frame.
+
+    Each sample writes the sum into a new memory-mapped .npy file in tmp_dir, and the checkpoint
+    next to it names the sum file together with the index of the last accumulated sample. The
+    checkpoint is replaced only after its sum is flushed, so an interrupted run restarts from a
+    matching sum and index without double counting samples, and only the final mean is encoded as EXR.
+    """
+    def __init__(self, tmp_dir, name, frame):
+        self.tmp_dir = tmp_dir
+        self.base = os.path.join(tmp_dir, f'ref_{name}_{frame:04d}')
+        self.checkpoint_path = self.base + '.json'
+
+    def sum_path(self, idx):
+        return f'{self.base}_sum_{idx:04d}.npy'
+
+    def checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    def add(self, img, idx):
+        checkpoint = self.checkpoint()
+        if checkpoint is not None and idx == config.REF_START_SAMPLE_INDEX:
+            # Restarting the accumulation, the sum file of the old checkpoint may be overwritten below
+            os.remove(self.checkpoint_path)
+            old_sum = os.path.join(self.tmp_dir, checkpoint['sum'])
+            if os.path.exists(old_sum):
+                os.remove(old_sum)
+            checkpoint = None
+        path = self.sum_path(idx)
+        acc = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=img.shape)
+        if checkpoint is None:
+            acc[...] = img
+            count = 1
+        else:
+            np.add(np.load(os.path.join(self.tmp_dir, checkpoint['sum']), mmap_mode='r'), img, out=acc)
+            count = checkpoint['count'] + 1
+        acc.flush()
+        del acc
+
+        # Switch to the new sum by replacing the checkpoint atomically, then drop the previous sum
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'index': idx, 'count': count, 'sum': os.path.basename(path)}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        if checkpoint is not None and checkpoint['sum'] != os.path.basename(path):
+            os.remove(os.path.join(self.tmp_dir, checkpoint['sum']))
+
+    def mean(self):
+        checkpoint = self.checkpoint()
+        acc = np.load(os.path.join(self.tmp_dir, checkpoint['sum']), mmap_mode='r')
+        return (acc / checkpoint['count']).astype(np.float32)
+
 def process_restirref_frame(name, frame, idx, tmp_dir):
     try:
-        last_idx = max(config.REF_START_SAMPLE_INDEX, idx - 1)
-
         rendered_path = os.path.join(tmp_dir, f'{name}_{frame:04d}_{idx:04d}.exr')
-        prev_ref_path = os.path.join(tmp_dir, f'ref_{name}_{frame:04d}_{last_idx:04d}.exr')
         new_ref_path = os.path.join(tmp_dir, f'ref_{name}_{frame:04d}_{idx:04d}.exr')
 
-        if idx == config.REF_START_SAMPLE_INDEX:
-            shutil.move(rendered_path, new_ref_path)
-        else:
-            num_prev = last_idx - config.REF_START_SAMPLE_INDEX + 1
-            img_prev = exr.read_all(prev_ref_path)['default']
-            img = exr.read_all(rendered_path)['default']
-            new_avg = (num_prev * img_prev + img) / (num_prev + 1)
-            exr.write(new_ref_path, new_avg, compression=exr.ZIP_COMPRESSION)
-            # Remove
+        acc = RunningMean(tmp_dir, name, frame)
+        checkpoint = acc.checkpoint()
+        if checkpoint is not None and checkpoint['index'] >= idx and idx != config.REF_START_SAMPLE_INDEX:
+            # Already accumulated before a restart
             os.remove(rendered_path)
-            os.remove(prev_ref_path)
+            return
+        if checkpoint is None and idx != config.REF_START_SAMPLE_INDEX:
+            print(f'WARN: no running mean for {name} frame {frame}, restarting accumulation at {idx}.')
+
+        acc.add(read_default(rendered_path, 'sample'), idx)
+        os.remove(rendered_path)
+
+        # Encode the EXR only once all samples are accumulated
+        if idx == config.REF_END_SAMPLE_PIXEL - 1:
+            write_buffer(new_ref_path, acc.mean())
 
     except Exception as e:
         func_name = sys._getframe()
@@ -246,32 +393,33 @@ def process_refrestir_frame_last(name, frame, idx, src_dir):
         print(f"[{func_name}] Error processing frame {frame}: {str(e)}")
 
 reflist = ['current', 'envLight', 'emissive']
-def postprocess_refrestir(src_dir, scene_name, frames, idx):
+def postprocess_refrestir(pool, src_dir, dest_dir, scene_name, frames, idx, rendered=None):
+    # Samples are accumulated in order, so finish the previous one first
+    pool.wait()
+
     # Create tmp directory
-    tmp_dir = os.path.join(src_dir, 'tmp')
+    tmp_dir = os.path.join(dest_dir, 'tmp')
     os.makedirs(tmp_dir, exist_ok=True)
 
     # Move the images in src_dir to the tmp_dir with appending the index
-    exr_list = os.listdir(src_dir)
-    exr_list = [f for f in exr_list if f.endswith('.exr')]
-    exr_list = [f for f in exr_list if any([f.startswith(f'{name}_') for name in reflist])]
+    rendered = rendered or Manifest(src_dir, persist=False)
+    exr_list = [f for f in rendered.files(prefixed=False) if any([f.startswith(f'{name}_') for name in reflist])]
     if len(exr_list) == 0:
         print('ERROR2: No exr files found.')
         return
     for f in exr_list:
         shutil.move(os.path.join(src_dir, f), os.path.join(tmp_dir, f'{f.split(".")[0]}_{idx:04d}.exr'))
 
-    # Process multiprocessing
-    num_workers = min(60, mp.cpu_count() - 4) # 60 is maximum for Windows
-    with mp.Pool(processes=num_workers) as pool:
-        for name in reflist:
-            pool.starmap(partial(process_restirref_frame, name), [(frame, idx, tmp_dir) for frame in frames])
+    # Accumulate in the background while Mogwai renders the next sample
+    for name in reflist:
+        pool.submit(partial(process_restirref_frame, name), [(frame, idx, tmp_dir) for frame in frames])
 
     # Last sample processing
     if idx == config.REF_END_SAMPLE_PIXEL - 1:
-        with mp.Pool(processes=num_workers) as pool:
-            for name in reflist:
-                pool.starmap(partial(process_refrestir_frame_last, name), [(frame, idx, src_dir) for frame in frames])
+        pool.wait()
+        for name in reflist:
+            pool.submit(partial(process_refrestir_frame_last, name), [(frame, idx, dest_dir) for frame in frames])
+        pool.wait()
         # Remove tmp
         shutil.rmtree(tmp_dir)
 
@@ -280,23 +428,19 @@ def process_centergbuf(frame, src_dir, dest_dir):
     try:
         linearz_path = os.path.join(src_dir, f'linearZ_{frame:04d}.exr')
         if os.path.exists(linearz_path):
-            linearz_img = exr.read_all(linearz_path)['default']
-            depth_img = linearz_img[:,:,0:1]
-            exr.write(os.path.join(dest_dir, f'depth_{frame:04d}.exr'), depth_img, compression=exr.ZIP_COMPRESSION)
+            # Only the first channel is decoded
+            depth_img = exr.open_lazy(linearz_path).take('default', [0])
+            write_buffer(os.path.join(dest_dir, f'depth_{frame:04d}.exr'), depth_img)
         else:
             print(f'WARN: {linearz_path} not found.')
     except Exception as e:
         func_name = sys._getframe()
         print(f"[{func_name}] Error processing frame {frame}: {str(e)}")
 
-def postprocess_centergbuf(src_dir, scene_name, frames):
+def postprocess_centergbuf(pool, src_dir, scene_name, frames):
     print('\tPost-processing the centergbuf...', end=' ', flush=True)
 
-    # Process multiprocessing
-    num_workers = min(60, mp.cpu_count() - 4) # 60 is maximum for Windows
-    with mp.Pool(processes=num_workers) as pool:
-        pool.starmap(process_centergbuf, [(frame, src_dir, src_dir) for frame in frames])
-    pool.close()
+    pool.map(process_centergbuf, [(frame, src_dir, src_dir) for frame in frames])
 
     print('Done')
 
@@ -305,63 +449,387 @@ def process_multigbuf(src_dir, frame):
         # Extract depth from LinearZ
         linearz_path = os.path.join(src_dir, f'linearZ_multi_{frame:04d}.exr')
         if os.path.exists(linearz_path):
-            linearz_img = exr.read_all(linearz_path)['default']
-            depth_img = linearz_img[:,:,0:1]
-            exr.write(os.path.join(src_dir, f'depth_multi_{frame:04d}.exr'), depth_img, compression=exr.ZIP_COMPRESSION)
+            depth_img = exr.open_lazy(linearz_path).take('default', [0])
+            write_buffer(os.path.join(src_dir, f'depth_multi_{frame:04d}.exr'), depth_img)
             # remove linearZ
             # os.remove(linearz_path)
         else:
             print(f'WARN: {linearz_path} not found.')
 
         # Normalize normal_multi
-        img = exr.read_all(os.path.join(src_dir, f'normal_multi_{frame:04d}.exr'))['default']
+        img = read_default(os.path.join(src_dir, f'normal_multi_{frame:04d}.exr'), 'normal')
         factor = np.linalg.norm(img, axis=2, keepdims=True)
         factor[factor == 0] = 1
         img /= factor
-        exr.write(os.path.join(src_dir, f'normal_multi_{frame:04d}.exr'), img, compression=exr.ZIP_COMPRESSION)
+        write_buffer(os.path.join(src_dir, f'normal_multi_{frame:04d}.exr'), img)
 
     except Exception as e:
         func_name = sys._getframe()
         print(f"[{func_name}] Error processing frame {frame}: {str(e)}")
 
-def postprocess_multigbuf(src_dir, scene_name, frames):
+def postprocess_multigbuf(pool, src_dir, scene_name, frames):
     print('\tPost-processing the multigbuf...', end=' ', flush=True)
     # Normalize normal_multi
-    num_workers = min(60, mp.cpu_count()) # 60 is maximum for Windows
-    with mp.Pool(processes=num_workers) as pool:
-        pool.starmap(process_multigbuf, [(src_dir, frame) for frame in frames])
+    pool.map(process_multigbuf, [(src_dir, frame) for frame in frames])
     print('Done.')
 
-def postprocess(method, scene_name, sample_idx=0):
-    src_dir = f'{OUT_DIR}/'
-    # Find frames
-    exr_list = os.listdir(src_dir)
-    exr_list = [f for f in exr_list if f.endswith('.exr')]
-    if len(exr_list) == 0:
+def postprocess(pool, method, scene_name, sample_idx=0, src_dir=None):
+    # src_dir is the job directory Mogwai rendered into; results are collected in OUT_DIR
+    dest_dir = f'{OUT_DIR}/'
+    src_dir = src_dir or dest_dir
+    # Find frames, the job directory is indexed once and only for this step
+    same_dir = os.path.abspath(src_dir) == os.path.abspath(dest_dir)
+    rendered = get_manifest(src_dir) if same_dir else Manifest(src_dir, persist=False)
+    if len(rendered) == 0:
         print('No exr files found. Skip.')
         return
-    frames = sorted(list(set([int(f.split('.')[0].split('_')[-1]) for f in exr_list])))
+    frames = rendered.frames()
 
     if method == 'input':
-        postprocess_input(src_dir, scene_name, frames, sample_idx)
+        postprocess_input(pool, src_dir, dest_dir, scene_name, frames, sample_idx, rendered=rendered)
     elif method == 'secondinput':
-        postprocess_input(src_dir, scene_name, frames, sample_idx, '2')
+        postprocess_input(pool, src_dir, dest_dir, scene_name, frames, sample_idx, '2', rendered=rendered)
     elif method == 'ref':
         postprocess_ref(src_dir, scene_name, frames)
     elif method == 'ref_restir':
-        postprocess_refrestir(src_dir, scene_name, frames, sample_idx)
+        postprocess_refrestir(pool, src_dir, dest_dir, scene_name, frames, sample_idx, rendered=rendered)
     elif method == 'centergbuf':
-        postprocess_centergbuf(src_dir, scene_name, frames)
+        postprocess_centergbuf(pool, src_dir, scene_name, frames)
     elif method == 'multigbuf':
-        postprocess_multigbuf(src_dir, scene_name, frames)
+        postprocess_multigbuf(pool, src_dir, scene_name, frames)
     else:
         print(f'Post-processing for {method} is not implemented.')
 
+    # Collect what is left in the job directory, e.g., mvec and camera matrices
+    collect_job_dir(src_dir, dest_dir)
+
     if method == 'input' or method == 'secondinput':
         if sample_idx == config.SAMPLES_PER_PIXEL - 1:
-            postprocess_common(src_dir, scene_name, frames)
+            postprocess_common(dest_dir, scene_name, frames)
     else:
-        postprocess_common(src_dir, scene_name, frames)
+        postprocess_common(dest_dir, scene_name, frames)
+
+def collect_job_dir(job_dir, dest_dir):
+    if os.path.abspath(job_dir) == os.path.abspath(dest_dir):
+        return
+    for f in os.listdir(job_dir):
+        shutil.move(os.path.join(job_dir, f), os.path.join(dest_dir, f))
+    os.rmdir(job_dir)
+
+def pack_frame(src_dir, frame, files):
+    # Pack the buffers of a frame into one multi-layer EXR, e.g., albedo_0100.exr -> layer albedo
+    # with channels albedo.R, albedo.G, ..., with the precision of each buffer's output policy
+    try:
+        layers, channel_names, precisions = {}, {}, {}
+        for f in files:
+            name = buffer_name(f)
+            img = exr.open(os.path.join(src_dir, f))
+            for group in img.root_channels:
+                layer = name if group == 'default' else f'{name}.{group}'
+                channels = img.channel_map[group]
+                layers[layer] = img.get(group)
+                channel_names[layer] = [c.split('.')[-1] for c in channels]
+                precisions[layer] = getattr(exr, output_policy(f)['precision'])
+        compression = getattr(exr, f"{config.EXR_DEFAULT_POLICY['compression']}_COMPRESSION")
+        exr.write(os.path.join(src_dir, PACKED_NAME.format(frame=frame)), layers, channel_names, precisions, compression)
+        for f in files:
+            os.remove(os.path.join(src_dir, f))
+    except Exception as e:
+        func_name = sys._getframe()
+        print(f"[{func_name}] Error packing frame {frame}: {str(e)}")
+
+def pack_frames(pool, src_dir):
+    print('\tPacking the buffers of each frame...', end=' ', flush=True)
+    manifest = get_manifest(src_dir)
+    frames = {}
+    for f in manifest.files(prefixed=False):
+        if manifest.entries[f]['kind'] != 'packed':
+            frames.setdefault(manifest.entries[f]['frame'], []).append(f)
+    pool.map(pack_frame, [(src_dir, frame, files) for frame, files in sorted(frames.items())])
+    manifest.update()
+    print('Done')
+
+class Job:
+    """One Mogwai launch rendering into its own directory, followed by its post-processing.
+
+    `spec` holds the main.py variables (NAME, FILE, ANIM, METHOD, SEED_OFFSET, ...) of the launch.
+    It is handed to main.py as JSON through the environment, so no source file is modified.
+    """
+    def __init__(self, spec, sample_idx, max_tries=None):
+        self.method = spec['METHOD']
+        self.scene_name = spec['NAME']
+        self.sample_idx = sample_idx
+        self.max_tries = max_tries # None retries until Mogwai succeeds
+        self.out_dir = os.path.join(JOB_DIR, f'j{sample_idx:04d}').replace('\\', '/')
+        self.spec = dict(spec, OUT_DIR=self.out_dir)
+
+    def __repr__(self):
+        return f'{self.scene_name}/{self.method} sample {self.sample_idx}'
+
+class Pipeline:
+    """Runs render jobs and their post-processing as two stages connected by a bounded queue.
+
+    The render stage launches Mogwai for one launch after another while the post-processing
+    stage works through the jobs rendered before, so the GPU does not idle while the CPU
+    averages EXRs. The queue bounds how far rendering may run ahead of post-processing.
+    A launch is a list of jobs rendered by a single Mogwai process.
+    """
+    def __init__(self, render, postprocess, depth=2):
+        self.render = render
+        self.postprocess = postprocess
+        self.depth = depth
+        self.busy = {'render': 0.0, 'postprocess': 0.0}
+        self.wall = 0.0
+
+    def run(self, launches):
+        start_time = time.time()
+        jobs_queue = queue.Queue(maxsize=self.depth)
+        thread = threading.Thread(target=self._postprocess_stage, args=(jobs_queue,))
+        thread.start()
+        try:
+            for jobs in launches:
+                self._timed('render', self.render, jobs)
+                for job in jobs:
+                    jobs_queue.put(job) # Blocks while post-processing is `depth` jobs behind
+        finally:
+            jobs_queue.put(None)
+            thread.join()
+            self.wall += time.time() - start_time
+
+    def _postprocess_stage(self, jobs_queue):
+        while True:
+            job = jobs_queue.get()
+            if job is None:
+                break
+            try:
+                self._timed('postprocess', self.postprocess, job)
+            except Exception as e:
+                print(f'[postprocess] Error processing {job}: {str(e)}')
+
+    def _timed(self, stage, func, arg):
+        start_time = time.time()
+        func(arg)
+        self.busy[stage] += time.time() - start_time
+
+    def report(self):
+        print('Stage utilization:')
+        for stage, busy in self.busy.items():
+            utilization = 100 * busy / self.wall if self.wall > 0 else 0
+            print(f'\t{stage:<12}: {utilization:5.1f}% busy ({busy:.1f} s of {self.wall:.1f} s)')
+
+class SceneCache:
+    """Decides whether a launch rebuilds the scene cache or loads with SceneBuilderFlags.UseCache.
+
+    With the 'session' policy, the cache of a scene is rebuilt by its first launch in this
+    session and again whenever the .pyscene file or an asset it references changes (by mtime
+    and size); every other launch uses the cache. The 'rebuild' policy always rebuilds.
+    """
+    ASSET_PATTERN = re.compile(r'["\']([^"\']+\.(?:pyscene|py|fbx|gltf|glb|obj|usd|usda|usdc|usdz|dds|png|jpg|jpeg|tga|exr|hdr))["\']', re.IGNORECASE)
+
+    def __init__(self, policy='session'):
+        self.policy = policy
+        self.built = {} # Scene file -> fingerprint when its cache was rebuilt
+        self.load_times = {'rebuild': [], 'use': []}
+
+    def fingerprint(self, scene_file):
+        if not os.path.isfile(scene_file):
+            return None
+        with open(scene_file, 'r', errors='ignore') as f:
+            code = f.read()
+        scene_dir = os.path.dirname(scene_file)
+        paths = [scene_file] + [os.path.join(scene_dir, m) for m in self.ASSET_PATTERN.findall(code)]
+        stats = []
+        for path in sorted(set(paths)):
+            if os.path.isfile(path):
+                st = os.stat(path)
+                stats.append((path, st.st_mtime_ns, st.st_size))
+        return stats
+
+    def mode(self, scene_file):
+        # Mode of the next launch and, for a rebuild in the 'session' policy, the fingerprint to record
+        # once it succeeds. The scene is only fingerprinted when the policy needs it.
+        if self.policy == 'rebuild':
+            return 'rebuild', None
+        fingerprint = self.fingerprint(scene_file)
+        if scene_file in self.built and self.built[scene_file] == fingerprint:
+            return 'use', None
+        return 'rebuild', fingerprint
+
+    def loaded(self, scene_file, mode, fingerprint, stdout):
+        # Called after a successful launch with the fingerprint returned by `mode` before it
+        if mode == 'rebuild' and self.policy == 'session':
+            self.built[scene_file] = fingerprint
+        match = re.search(r'Scene load time: ([0-9.]+) s', stdout)
+        if match:
+            self.load_times[mode].append(float(match.group(1)))
+            return float(match.group(1))
+        return None
+
+    def report(self):
+        print('Scene loading:')
+        for mode, times in self.load_times.items():
+            if times:
+                print(f'\t{mode:<12}: {len(times)} launches, {sum(times) / len(times):.2f} s on average, {sum(times):.1f} s total')
+
+# Methods whose animation range can be split across concurrent Mogwai processes, with the number
+# of warm-up frames rendered and discarded before each shard. Temporal methods need a history.
+# 'input' is not sharded since CapturePass writes its camera matrices per launch.
+SHARDABLE_METHODS = {
+    'ref': 0,
+    'centergbuf': 0,
+    'multigbuf': 0,
+    'secondinput': config.SHARD_WARMUP_FRAMES,
+    'ref_restir': config.SHARD_WARMUP_FRAMES,
+}
+
+CAPTURE_PATTERN = re.compile(r'^(.+)_(\d{4,})\.exr$')
+
+# CapturePass formats '<directory>/<channel>_<frame>.exr' and '<directory>/../camera_matrices_template.h'
+# into char[100] buffers, so job and shard directories are kept short and flat under JOB_DIR
+CAPTURE_PATH_LIMIT = 99
+LONGEST_CAPTURE_FILE = 'diffuseOpacity_multi_0000.exr'
+
+def check_capture_dir(directory):
+    path = f'{directory}/{LONGEST_CAPTURE_FILE}'
+    if len(path) > CAPTURE_PATH_LIMIT:
+        raise ValueError(f'Capture path {path} is longer than the {CAPTURE_PATH_LIMIT} characters CapturePass supports, use a shorter OUT_DIR.')
+
+def shard_ranges(anim, shards, warmup=0):
+    # Split [start, end] into contiguous (first, start, end) ranges, `first` including the warm-up frames
+    start, end = anim
+    num_frames = end - start + 1
+    shards = max(1, min(shards, num_frames))
+    ranges = []
+    for k in range(shards):
+        a = start + k * num_frames // shards
+        b = start + (k + 1) * num_frames // shards - 1
+        ranges.append((max(start, a - warmup), a, b))
+    return ranges
+
+def merge_shards(shard_dirs, ranges, out_dir):
+    # CapturePass numbers the captures of a launch from its first frame: drop the warm-up frames of
+    # each shard and offset the others so the files are numbered as by a single launch. Frames
+    # captured past the end of a shard (the dummy frame) are only kept for the last shard.
+    origin = None
+    for k, (shard_dir, (first, a, b)) in enumerate(zip(shard_dirs, ranges)):
+        captures = []
+        for f in os.listdir(shard_dir):
+            match = CAPTURE_PATTERN.match(f)
+            if match:
+                captures.append((f, match.group(1), int(match.group(2))))
+            else:
+                shutil.move(os.path.join(shard_dir, f), os.path.join(out_dir, f))
+        if captures:
+            first_index = min(index for _, _, index in captures)
+            if origin is None:
+                origin = first_index if k == 0 else 0
+            for f, channel, index in captures:
+                offset = index - first_index - (a - first)
+                if offset < 0 or (offset > b - a and k < len(ranges) - 1):
+                    os.remove(os.path.join(shard_dir, f))
+                    continue
+                global_index = origin + a - ranges[0][1] + offset
+                shutil.move(os.path.join(shard_dir, f), os.path.join(out_dir, f'{channel}_{global_index:04d}.exr'))
+        shutil.rmtree(shard_dir)
+
+def render_jobs(jobs, dummy=False, scene_cache=None, shards=1):
+    # Start from empty job directories, e.g., after an interrupted run
+    for job in jobs:
+        check_capture_dir(job.out_dir)
+        if os.path.exists(job.out_dir):
+            shutil.rmtree(job.out_dir)
+        os.makedirs(job.out_dir)
+
+    def samples(dirs):
+        # Several ref_restir samples share one launch (and one scene load)
+        return [[job.spec['SEED_OFFSET'], d] for job, d in zip(jobs, dirs)]
+
+    spec = jobs[0].spec
+    if len(jobs) > 1:
+        spec = dict(spec, SAMPLES=samples([job.out_dir for job in jobs]))
+    name = f'{jobs[0]}' if len(jobs) == 1 else f'{jobs[0]}-{jobs[-1].sample_idx}'
+
+    warmup = SHARDABLE_METHODS.get(jobs[0].method)
+    if shards <= 1 or warmup is None or spec['INTERACTIVE']:
+        render_launch(spec, name, jobs[0].max_tries, dummy, scene_cache)
+        return
+
+    # Split the animation range across concurrent Mogwai processes, each rendering into
+    # a shard directory per job next to the job directory, e.g., jobs/j0000s01
+    ranges = shard_ranges(spec['ANIM'], shards, warmup)
+    shard_dirs = [[f'{job.out_dir}s{k:02d}' for k in range(len(ranges))] for job in jobs]
+    launches = []
+    for k, (first, a, b) in enumerate(ranges):
+        dirs = [job_dirs[k] for job_dirs in shard_dirs]
+        for d in dirs:
+            check_capture_dir(d)
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.makedirs(d)
+        shard_spec = dict(spec, OUT_DIR=dirs[0], SHARD=[first, b])
+        if len(jobs) > 1:
+            shard_spec['SAMPLES'] = samples(dirs)
+        launches.append((shard_spec, f'{name} shard {k + 1}/{len(ranges)} (frames {a}-{b})'))
+
+    # Concurrent processes must not rebuild the scene cache at the same time: a rebuild is done
+    # by the first shard alone and the others use its cache. If the first shard fails, the others
+    # run one after another, so a rebuild is never concurrent with another launch.
+    mode = None
+    if scene_cache and scene_cache.mode(spec['FILE'])[0] == 'rebuild':
+        retcode = render_launch(*launches[0], jobs[0].max_tries, dummy, scene_cache)
+        launches = launches[1:]
+        if retcode == 0:
+            mode = 'use'
+        else:
+            for shard_spec, shard_name in launches:
+                render_launch(shard_spec, shard_name, jobs[0].max_tries, dummy, scene_cache)
+            launches = []
+    threads = [threading.Thread(target=render_launch, args=(shard_spec, shard_name, jobs[0].max_tries, dummy, scene_cache, mode))
+               for shard_spec, shard_name in launches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for job, job_dirs in zip(jobs, shard_dirs):
+        merge_shards(job_dirs, ranges, job.out_dir)
+
+def render_launch(spec, name, max_tries=None, dummy=False, scene_cache=None, mode=None):
+    # Run Mogwai for `spec` until it succeeds or `max_tries` retries are spent
+    def launch():
+        scene_file = spec['FILE']
+        if mode or not scene_cache:
+            launch_mode, fingerprint = mode or 'rebuild', None
+        else:
+            launch_mode, fingerprint = scene_cache.mode(scene_file)
+        retcode, stdout = run(dict(spec, SCENE_CACHE=launch_mode), dummy=dummy)
+        if retcode == 0 and scene_cache:
+            load_time = scene_cache.loaded(scene_file, launch_mode, fingerprint, stdout)
+            if load_time is not None:
+                print(f'[render] {name}: scene loaded in {load_time:.2f} s ({launch_mode} cache)', flush=True)
+        return retcode, stdout
+
+    print(f'[render] {name}...', flush=True)
+    retcode, stdout = launch()
+    tries = 0
+    while retcode != 0 and (max_tries is None or tries < max_tries):
+        print(f'[render] {name}: Unsucessful, retry', flush=True)
+        retcode, stdout = launch()
+        tries += 1
+
+    if retcode != 0:
+        print(stdout)
+    return retcode
+
+def batched(jobs, size):
+    return [jobs[i:i+size] for i in range(0, len(jobs), size)]
+
+def postprocess_job(pool, job, enabled=True):
+    print(f'[postprocess] {job}...', flush=True)
+    if enabled:
+        postprocess(pool, job.method, job.scene_name, job.sample_idx, job.out_dir)
+    else:
+        collect_job_dir(job.out_dir, OUT_DIR)
 
 def build(args):
     print('Building..', end=' ')
@@ -407,10 +875,18 @@ def monitor_log_file(log_file, stop_signal):
         except KeyboardInterrupt:
             print("\nStopped monitoring the log file.")
 
-def run(noscript=False, dummy=False):
+# Environment variable main.py reads its job description from
+JOB_ENV = "RESTIR_PT_JOB"
+
+def run(spec=None, noscript=False, dummy=False):
+    # Pass the job description to main.py
+    env = dict(os.environ)
+    if spec is not None:
+        env[JOB_ENV] = json.dumps(spec)
+
     # Call Mogwai
     if dummy:
-        ret = subprocess.run(['python', 'main.py'], capture_output=True, text=True)
+        ret = subprocess.run(['python', 'main.py'], capture_output=True, text=True, env=env)
         if ret.returncode != 0:
             print(ret.stderr)
         print(ret.stdout)
@@ -423,7 +899,7 @@ def run(noscript=False, dummy=False):
             binary_args = ["--script=main.py"]
         script_dir = os.path.abspath(os.path.dirname(__file__))
         binary_abs_path = os.path.join(script_dir, binary_path)
-        ret = subprocess.run([binary_abs_path] + binary_args, capture_output=True, text=True)
+        ret = subprocess.run([binary_abs_path] + binary_args, capture_output=True, text=True, env=env)
         # ret = subprocess.run([binary_abs_path] + binary_args)
         if ret.returncode != 0:
             print(ret.stdout)
@@ -442,19 +918,15 @@ if __name__ == "__main__":
     parser.add_argument('--dir', default='dataset')
     parser.add_argument('--mogwai', action='store_true', default=False)
     parser.add_argument('--dummy_falcor', action='store_true', default=False)
+    parser.add_argument('--shards', type=int, default=1, help='Concurrent Mogwai processes splitting the animation range of ref, centergbuf, multigbuf, secondinput and ref_restir')
+    parser.add_argument('--pack', action='store_true', default=False, help='Pack the buffers of each frame into one multi-layer EXR')
+    parser.add_argument('--scene_cache', default='session', choices=['session', 'rebuild'], help='Rebuild the scene cache once per scene and session, or on every launch')
     args = parser.parse_args()
 
-    update_pyvariable("main.py", "DUMMY_RUN", args.dummy_falcor)
-
     if args.mogwai:
         run(noscript=True)
         exit()
 
-    # Update HOME_DIR
-    HOME_DIR = os.path.abspath('../').replace('\\', '/')
-    update_pyvariable("scene.py", "HOME_DIR", HOME_DIR)
-
-    # Import scene after updating HOME_DIR
     import scene
 
     OUT_DIR = os.path.abspath('./output').replace('\\', '/')
@@ -468,14 +940,7 @@ if __name__ == "__main__":
 
     if args.interactive:
         args.nopostprocessing = True
-        update_pyvariable("main.py", "INTERACTIVE", True)
-        update_pyvariable("main.py", "REF_COUNT", 65536)
-        # update_pyvariable("main.py", "SAMPLES_PER_PIXEL", 1)
     else:
-        update_pyvariable("main.py", "INTERACTIVE", False)
-        update_pyvariable("main.py", "OUT_DIR", OUT_DIR)
-        update_pyvariable("main.py", "REF_COUNT", config.REF_SAMPLES_PER_PIXEL)
-        # update_pyvariable("main.py", "SAMPLES_PER_PIXEL", 2)
         # Create output directory
         os.makedirs(OUT_DIR, exist_ok=True)
 
@@ -491,17 +956,41 @@ if __name__ == "__main__":
     print('automated.py for scenes', scene_names)
 
 
+    # Every Mogwai launch renders into its own directory under JOB_DIR
+    JOB_DIR = os.path.join(OUT_DIR, 'jobs').replace('\\', '/')
+    os.makedirs(JOB_DIR, exist_ok=True)
+    try:
+        check_capture_dir(f'{JOB_DIR}/j0000s00')
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    # CapturePass looks for the camera matrix template in the parent of its directory
+    camera_template = os.path.join(os.path.dirname(OUT_DIR), 'camera_matrices_template.h')
+    if os.path.exists(camera_template):
+        shutil.copy(camera_template, JOB_DIR)
+
     manager = RobocopyManager()
+    pool = PostprocessPool()
+    scene_cache = SceneCache(args.scene_cache)
+    pipeline = Pipeline(partial(render_jobs, dummy=args.dummy_falcor, scene_cache=scene_cache, shards=args.shards), partial(postprocess_job, pool, enabled=not args.nopostprocessing))
     for i in range(len(scene_names)):
         scene_name = scene_names[i]
         dest_dir = os.path.join(directory, scene_name)
 
-        change_scene(scene_name)
-
         for method in args.methods:
-            change_method(method)
-
-            update_pyvariable("main.py", "SEED_OFFSET", 0)
+            # main.py variables shared by all launches of this scene and method
+            spec = {
+                'NAME': scene_name,
+                'FILE': scene.defs[scene_name]['file'],
+                'ANIM': scene.defs[scene_name]['anim'],
+                'METHOD': method,
+                'SEED_OFFSET': 0,
+                'SAMPLE_INDEX': 0,
+                'INPUT_SUFFIX': '',
+                'INTERACTIVE': args.interactive,
+                'REF_COUNT': 65536 if args.interactive else config.REF_SAMPLES_PER_PIXEL,
+                'DUMMY_RUN': args.dummy_falcor,
+            }
 
             if method == 'ref_restir':
                 sample_idx = config.REF_START_SAMPLE_INDEX
@@ -511,103 +1000,74 @@ if __name__ == "__main__":
                     # Create tmp directory if not exist
                     os.makedirs(tmp_dir, exist_ok=True)
                 else:
-                    # Or check the minimum sample_idx to restart with
-                    exr_list = os.listdir(tmp_dir)
-                    exr_list = [f for f in exr_list if f.endswith('.exr')]
-                    exr_list = [f for f in exr_list if f.startswith('ref_')]
-                    # Check all reflist files exist for all frames
+                    # Or check the minimum sample_idx to restart with from the running mean checkpoints
+                    checkpoints = os.listdir(tmp_dir)
+                    checkpoints = [f for f in checkpoints if f.startswith('ref_') and f.endswith('.json')]
+                    # Check all reflist checkpoints exist for all frames
                     len_anim = scene.defs[scene_name]['anim'][1] - scene.defs[scene_name]['anim'][0] + 1
                     fulllen = (len_anim + 1) * len(reflist) # +1 for the dummy frame
-                    if len(exr_list) != fulllen:
-                        print(f'No complete ref files found: (actual {len(exr_list)} != expected {fulllen}). Restarting from {config.REF_START_SAMPLE_INDEX}...')
+                    if len(checkpoints) != fulllen:
+                        print(f'No complete ref checkpoints found: (actual {len(checkpoints)} != expected {fulllen}). Restarting from {config.REF_START_SAMPLE_INDEX}...')
                     else:
-                        min_idx = min([int(f.split('_')[-1].split('.')[0]) for f in exr_list])
+                        indices = []
+                        for f in checkpoints:
+                            with open(os.path.join(tmp_dir, f), 'r') as fp:
+                                indices.append(json.load(fp)['index'])
+                        min_idx = min(indices)
                         if min_idx >= config.REF_START_SAMPLE_INDEX and min_idx < config.REF_END_SAMPLE_PIXEL:
-                            # Force rename to min_idx
-                            def rreplace(s, old, new, occurrence):
-                                li = s.rsplit(old, occurrence)
-                                return new.join(li)
-
-                            for f in exr_list:
-                                newname = rreplace(f, f.split('.')[0].split("_")[-1], f'{min_idx:04d}', 1)
-                                os.rename(os.path.join(tmp_dir, f), os.path.join(tmp_dir, newname))
-
+                            # Frames already ahead of min_idx skip the samples they have accumulated
                             sample_idx = min_idx + 1
                             print(f'Restarting from {sample_idx}...')
 
-                while sample_idx < config.REF_END_SAMPLE_PIXEL:
-                    update_pyvariable("main.py", "SEED_OFFSET", sample_idx)
-                    print(f'Sample idx {sample_idx}:', end=' ', flush=True)
-                    retcode, stdout = run()
-                    if retcode != 0:
-                        print('Unsucessful, retry')
-                    else:
-                        postprocess(method, scene_name, sample_idx)
-                        print('Done.')
-                        sample_idx += 1
+                jobs = [Job(dict(spec, SEED_OFFSET=idx), idx) for idx in range(sample_idx, config.REF_END_SAMPLE_PIXEL)]
+                launches = batched(jobs, config.REF_SAMPLES_PER_LAUNCH)
 
             elif method == 'input' or method == 'secondinput':
-                if method == 'input': update_pyvariable("main.py", "INPUT_SUFFIX", '')
-                elif method == 'secondinput': update_pyvariable("main.py", "INPUT_SUFFIX", '2')
-
-                # Launch Mogwai
+                jobs = []
                 for sample_idx in range(config.SAMPLES_PER_PIXEL):
-                    update_pyvariable("main.py", "SAMPLE_INDEX", sample_idx)
-                    if method == 'input':
-                        update_pyvariable("main.py", "SEED_OFFSET", sample_idx)
-                    elif method == 'secondinput':
-                        update_pyvariable("main.py", "SEED_OFFSET", sample_idx + 1000000)
-                        # update_pyvariable("main.py", "SEED_OFFSET", sample_idx)
-                    print(f'Rendering Sample idx {sample_idx}...', end='', flush=True)
-                    retcode, stdout = run(dummy=args.dummy_falcor)
-                    tries = 0
-                    while retcode != 0 and tries < 3:
-                        print('Unsucessful, retry')
-                        retcode, stdout = run(dummy=args.dummy_falcor)
-                        tries += 1
-
-                    if retcode != 0:
-                        print(stdout)
-
-                    print('Done.')
-
-                    if not args.nopostprocessing:
-                        postprocess(method, scene_name, sample_idx)
+                    sample_spec = dict(spec,
+                        SAMPLE_INDEX=sample_idx,
+                        INPUT_SUFFIX='' if method == 'input' else '2',
+                        SEED_OFFSET=sample_idx if method == 'input' else sample_idx + 1000000)
+                    jobs.append(Job(sample_spec, sample_idx, max_tries=3))
+                launches = batched(jobs, 1)
             else:
-                print(f'Rendering...', end='', flush=True)
-                retcode, stdout = run()
-                tries = 0
-                while retcode != 0 and tries < 3:
-                    print('Unsucessful, retry')
-                    retcode, stdout = run()
-                    tries += 1
+                launches = [[Job(spec, 0, max_tries=3)]]
 
-                if retcode != 0:
-                    print(stdout)
-
-                print('Done.')
-                if not args.nopostprocessing:
-                    postprocess(method, scene_name, 0)
+            # Render and post-process the jobs concurrently
+            pipeline.run(launches)
 
             if args.interactive:
                 exit()
 
+        # Finish post-processing still running in the background
+        pool.wait()
+
         # Collect files starting with number
-        rendered_files = os.listdir(OUT_DIR)
-        rendered_files = [f for f in rendered_files if starts_with_number(f)]
+        manifest = get_manifest(OUT_DIR)
+        rendered_files = manifest.files(prefixed=True)
 
         # Rename the sample_idx from the filename
         for f in rendered_files:
             name_without_idx = '_'.join(f.split('_')[1:])
             print(f'{f} -> {name_without_idx}')
             shutil.move(os.path.join(OUT_DIR, f), os.path.join(OUT_DIR, name_without_idx))
+            manifest.rename(f, name_without_idx)
+        manifest.save()
+
+        if args.pack and not args.nopostprocessing:
+            pack_frames(pool, OUT_DIR)
 
         # Move data directory
         if os.path.exists(OUT_DIR):
             print(f'Moving to {dest_dir}...', end=' ', flush=True)
             os.makedirs(dest_dir, exist_ok=True)
             # Copy files explicitly for overwriting
+            # The manifest indexes OUT_DIR only, it is dropped once the scene is complete
+            drop_manifest(OUT_DIR)
             for f in os.listdir(OUT_DIR):
+                if f == os.path.basename(JOB_DIR):
+                    continue
                 shutil.move(os.path.join(OUT_DIR, f), os.path.join(dest_dir, f))
 
         if args.nas:
@@ -621,6 +1081,9 @@ if __name__ == "__main__":
         #     print('.', end='', flush=True)
         #     time.sleep(1)
 
+    pool.close()
+    pipeline.report()
+    scene_cache.report()
     print('Done.')
 
     exit()
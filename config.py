@@ -1,10 +1,32 @@
 # For input, secondinput method
 # SAMPLES_PER_PIXEL = 1 means total 2 spp, becasue 1 spp for input and 1 spp for secondinput
 SAMPLES_PER_PIXEL = 1
+# How the samples are averaged: 'batch' keeps them as rendered and averages them at once after
+# the last one, 'incremental' updates a running mean in an uncompressed float32 sidecar per sample
+INPUT_AVERAGING = 'incremental'
+
+# Output policy of the EXRs written by post-processing, by buffer name: the file name without the
+# sample and frame numbers, e.g., 'roughness' for 0003_roughness2_0100.exr. Unlisted settings use the default.
+#   compression: Codec of the final files, 'NO', 'RLE', 'ZIPS', 'ZIP', 'PIZ' or 'PXR24'
+#   precision:   'FLOAT' or 'HALF'
+#   channels:    Number of leading channels kept, e.g., 1 to store a gray buffer as a single channel
+EXR_DEFAULT_POLICY = {'compression': 'ZIP', 'precision': 'FLOAT', 'channels': None}
+EXR_BUFFER_POLICY = {
+    'roughness': {'precision': 'HALF'},
+    'opacity': {'precision': 'HALF'},
+}
+# Intermediate files are read back seconds later: written uncompressed in FLOAT
+EXR_INTERMEDIATE_COMPRESSION = 'NO'
 
 # For ref_restir method
 REF_START_SAMPLE_INDEX = 0
 REF_END_SAMPLE_PIXEL = 2048
+# Samples rendered per Mogwai launch, so the scene is loaded once per batch instead of once per sample
+REF_SAMPLES_PER_LAUNCH = 16
+
+# Frames rendered and discarded before each shard of a temporal method (secondinput, ref_restir)
+# when the animation range is split across processes (automated.py --shards)
+SHARD_WARMUP_FRAMES = 16
 
 # For ref (path tracing)
 REF_SAMPLES_PER_PIXEL = 8192
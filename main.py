@@ -1,4 +1,7 @@
 # type: ignore
+import os
+import json
+import time
 import random
 
 OUT_DIR = "C:/Users/hchoi/repositories/ReSTIR_PT/output"
@@ -17,6 +20,22 @@ MULTIGBUF_COUNT = 4
 INPUT_SUFFIX = ""
 DUMMY_RUN = False
 USE_GBUFFER_RT = False
+# ref_restir samples to render in this launch as [seed offset, output directory] pairs.
+# Empty renders the single sample given by SEED_OFFSET and OUT_DIR.
+SAMPLES = []
+# Frame range [first, last] of ANIM rendered by this launch when automated.py splits ANIM
+# across processes. Empty renders all of ANIM.
+SHARD = []
+# "rebuild" the scene cache of FILE or "use" the one built by a previous launch
+SCENE_CACHE = "rebuild"
+
+# Job description passed by automated.py as JSON in the environment; overrides the defaults above
+JOB_ENV = "RESTIR_PT_JOB"
+for key, value in json.loads(os.environ.get(JOB_ENV, "{}")).items():
+    if key not in globals():
+        print(f"WARN: Unknown job variable {key}")
+        continue
+    globals()[key] = value
 
 def frange(start, stop=None, step=None):
     # if set start=0.0 and step = 1.0 if not specified
@@ -40,51 +59,57 @@ def frange(start, stop=None, step=None):
         count += 1
 
 
-def add_path(g, gbuf, enable_restir=True, crn=False, path_seed_offset=0):
-    if DUMMY_RUN:
-        return "dummy", "dummy"
-
-    loadRenderPassLibrary("ReSTIRPTPass.dll")
-    loadRenderPassLibrary("ScreenSpaceReSTIRPass.dll")
-
-    # Toggle between ReSTIRPT and MegakernelPathTracer
+def path_dicts(enable_restir=True, crn=False, path_seed_offset=0):
+    # Dictionaries of the ReSTIRPTPass and ScreenSpaceReSTIRPass for the given seed
     if enable_restir:
-        PathTracer = createPass("ReSTIRPTPass", {
+        path_dict = {
             'samplesPerPixel': 1,
             # 'syncSeedSSReSTIR': True if crn else False,
             'fixSpatialSeed': True if crn else False,
             'temporalSeedOffset': (1000000 if crn else 0) + path_seed_offset,
-        })
-        path = "ReSTIRPT"
-        ScreenSpaceReSTIRPass = createPass("ScreenSpaceReSTIRPass", {
+        }
+        screen_restir_dict = {
             'NumReSTIRInstances': 1,
             'options':ScreenSpaceReSTIROptions(
                 fixSpatialSeed=True if crn else False,
                 temporalSeedOffset=(1000000 if crn else 0) + path_seed_offset
             )
-        })
-        screenReSTIR = "ScreenSpaceReSTIR"
+        }
     else:
         if crn:
             print("ERROR: CRN for PathTracing is not supported.")
             exit()
-        PathTracer = createPass("ReSTIRPTPass", {
+        path_dict = {
             'samplesPerPixel': 1,
             'pathSamplingMode': PathSamplingMode.PathTracing,
             'temporalSeedOffset': path_seed_offset,
-        })
-        path = "ReSTIRPT"
-        ScreenSpaceReSTIRPass = createPass("ScreenSpaceReSTIRPass", {
+        }
+        screen_restir_dict = {
             'options':ScreenSpaceReSTIROptions(
                 useTemporalResampling=False, useSpatialResampling=False,
                 temporalSeedOffset=path_seed_offset
             )
-        })
-        screenReSTIR = "ScreenSpaceReSTIR"
+        }
+    return path_dict, screen_restir_dict
 
-        # PathTracer = createPass("MegakernelPathTracer", {'samplesPerPixel': 1})
-        # path = "PathTracer"
-        # screenReSTIR = ""
+
+def add_path(g, gbuf, enable_restir=True, crn=False, path_seed_offset=0):
+    if DUMMY_RUN:
+        return "dummy", "dummy"
+
+    loadRenderPassLibrary("ReSTIRPTPass.dll")
+    loadRenderPassLibrary("ScreenSpaceReSTIRPass.dll")
+
+    # Toggle between ReSTIRPT and MegakernelPathTracer
+    path_dict, screen_restir_dict = path_dicts(enable_restir, crn, path_seed_offset)
+    PathTracer = createPass("ReSTIRPTPass", path_dict)
+    path = "ReSTIRPT"
+    ScreenSpaceReSTIRPass = createPass("ScreenSpaceReSTIRPass", screen_restir_dict)
+    screenReSTIR = "ScreenSpaceReSTIR"
+
+    # PathTracer = createPass("MegakernelPathTracer", {'samplesPerPixel': 1})
+    # path = "PathTracer"
+    # screenReSTIR = ""
 
     g.addPass(PathTracer, path)
     g.addPass(ScreenSpaceReSTIRPass, screenReSTIR)
@@ -100,12 +125,7 @@ def add_path(g, gbuf, enable_restir=True, crn=False, path_seed_offset=0):
     return path, screenReSTIR
 
 
-def add_gbuffer(g, pattern, init_seed=1):
-    if DUMMY_RUN:
-        return "dummy"
-
-    loadRenderPassLibrary("GBuffer.dll")
-
+def gbuffer_dict(pattern, init_seed=1):
     sample_pattern = SamplePattern.Center
     if pattern == 'Uniform':
         sample_pattern = SamplePattern.Uniform
@@ -127,6 +147,16 @@ def add_gbuffer(g, pattern, init_seed=1):
         'sampleIndex': SAMPLE_INDEX,
         'useAlphaTest': True,
     }
+    return dicts
+
+
+def add_gbuffer(g, pattern, init_seed=1):
+    if DUMMY_RUN:
+        return "dummy"
+
+    loadRenderPassLibrary("GBuffer.dll")
+
+    dicts = gbuffer_dict(pattern, init_seed)
 
     if USE_GBUFFER_RT:
         GBuffer = createPass("GBufferRT", dicts)
@@ -405,6 +435,18 @@ def render_ref_restir(start, end):
 
     return g
 
+def reseed_ref_restir(g):
+    # Recreate the seeded passes for SEED_OFFSET and capture into OUT_DIR without reloading the scene
+    gbuf = "GBufferRT" if USE_GBUFFER_RT else "GBufferRaster"
+    g.updatePass(gbuf, gbuffer_dict("Uniform", init_seed=SEED_OFFSET))
+    path_dict, screen_restir_dict = path_dicts(enable_restir=ENABLE_RESTIR, crn=False, path_seed_offset=SEED_OFFSET)
+    g.updatePass("ReSTIRPT", path_dict)
+    g.updatePass("ScreenSpaceReSTIR", screen_restir_dict)
+    if not INTERACTIVE:
+        capture_dict = g.getPass("CapturePass").getDictionary()
+        capture_dict['directory'] = OUT_DIR
+        g.updatePass("CapturePass", capture_dict)
+
 def render_centergbuf(start, end):
     g = None
     if not DUMMY_RUN:
@@ -483,8 +525,13 @@ elif 'Dining-room-dynamic' in NAME:
     step = -0.003
     num_frames = int((end - start) / step)
     ANIM = [0, num_frames]
-    dir_list = frange(start, end, step)
+    dir_list = list(frange(start, end, step))
 
+if SHARD:
+    ANIM = SHARD
+
+samples = SAMPLES if METHOD == 'ref_restir' and SAMPLES else [[SEED_OFFSET, OUT_DIR]]
+SEED_OFFSET, OUT_DIR = samples[0]
 
 print("ANIM = ", ANIM)
 if METHOD == 'input':
@@ -502,10 +549,50 @@ elif METHOD == 'centergbuf':
 elif METHOD == 'multigbuf':
     graph = render_multigbuf(*ANIM)
 
-if not DUMMY_RUN:
+def render_frames():
+    # m.profiler.enabled = True
+    if 'Dining-room-dynamic' in NAME:
+        for frame in range(ANIM[0], min(ANIM[1] + 1, len(dir_list))):
+            m.clock.frame = frame
+            print('Rendering frame:', m.clock.frame)
+            m.scene.lights[0].direction.y = dir_list[frame]
+            if METHOD == 'ref':
+                for _ in range(REF_COUNT):
+                    m.renderFrame()
+            else:
+                m.renderFrame()
+    else:
+        num_frames = ANIM[1] - ANIM[0] + 1
+
+        # Start frame
+        for frame in range(num_frames):
+            m.clock.frame = ANIM[0] + frame
+            print('Rendering frame:', m.clock.frame)
+            # if frame == ANIM[0] + 10:
+            #     m.profiler.startCapture()
+            if METHOD == 'ref':
+                for i in range(REF_COUNT):
+                    m.renderFrame()
+            elif METHOD == "multigbuf":
+                for i in range(MULTIGBUF_COUNT):
+                    m.renderFrame()
+            else:
+                m.renderFrame()
+
+    # capture = m.profiler.endCapture()
+    # m.profiler.enabled = False
+    # print(capture)
+    # with open('event.txt', 'w') as f: f.write(f'{capture}\n')
+
+if DUMMY_RUN:
+    for SEED_OFFSET, OUT_DIR in samples[1:]:
+        render_ref_restir(*ANIM)
+else:
     m.addGraph(graph)
-    # m.loadScene(FILE, buildFlags=SceneBuilderFlags.UseCache)
-    m.loadScene(FILE, buildFlags=SceneBuilderFlags.RebuildCache | SceneBuilderFlags.DontMergeMaterials)
+    cache_flags = SceneBuilderFlags.UseCache if SCENE_CACHE == "use" else SceneBuilderFlags.RebuildCache
+    load_start = time.time()
+    m.loadScene(FILE, buildFlags=cache_flags | SceneBuilderFlags.DontMergeMaterials)
+    print(f'Scene load time: {time.time() - load_start:.2f} s ({SCENE_CACHE} cache)')
     # Call this after scene loading
     m.scene.camera.nearPlane = 0.15 # Increase near plane to prevent Z-fighting
 
@@ -517,40 +604,11 @@ if not DUMMY_RUN:
     else:
         m.clock.pause()
 
-        # m.profiler.enabled = True
-        if 'Dining-room-dynamic' in NAME:
-            frame = 0
-            for y in dir_list:
-                m.clock.frame = frame
-                print('Rendering frame:', m.clock.frame)
-                m.scene.lights[0].direction.y = y
-                if METHOD == 'ref':
-                    for _ in range(REF_COUNT):
-                        m.renderFrame()
-                else:
-                    m.renderFrame()
-                frame += 1
-                if frame == ANIM[1] + 1: break
-        else:
-            num_frames = ANIM[1] - ANIM[0] + 1
-
-            # Start frame
-            for frame in range(num_frames):
-                m.clock.frame = ANIM[0] + frame
-                print('Rendering frame:', m.clock.frame)
-                # if frame == ANIM[0] + 10:
-                #     m.profiler.startCapture()
-                if METHOD == 'ref':
-                    for i in range(REF_COUNT):
-                        m.renderFrame()
-                elif METHOD == "multigbuf":
-                    for i in range(MULTIGBUF_COUNT):
-                        m.renderFrame()
-                else:
-                    m.renderFrame()
-
-        # capture = m.profiler.endCapture()
-        # m.profiler.enabled = False
-        # print(capture)
-        # with open('event.txt', 'w') as f: f.write(f'{capture}\n')
+        # The scene is loaded once and shared by all samples of this launch
+        for i, (SEED_OFFSET, OUT_DIR) in enumerate(samples):
+            if i > 0:
+                print(f'Rendering sample with seed offset {SEED_OFFSET}')
+                reseed_ref_restir(graph)
+                m.clock.time = 0
+            render_frames()
         exit()
@@ -1,4 +1,7 @@
-HOME_DIR = "C:/Users/hchoi/repositories"
+import os
+
+# Directory containing this repository and the scene repositories (e.g., ORCA)
+HOME_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..")).replace("\\", "/")
 FALCOR_DIR = f"{HOME_DIR}/ReSTIR_PT"
 NAS_DIR = f"F:"
 
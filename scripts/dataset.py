@@ -0,0 +1,386 @@
+import argparse
+import json
+import os
+import re
+import threading
+import zlib
+import numpy as np
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import exr
+except ImportError:
+    import exr
+
+# dataset.py: Chunked container for the rendered sequences of a scene, with random access to tiles
+#
+# <store>/index.json        Buffers with their shape, dtype, channels, tile size and frames, and the camera info
+#                           keyed by the same frame index as the buffers
+# <store>/<buffer>.bin      zlib-compressed tiles of the frames, appended as frames arrive
+# <store>/<buffer>.idx      (offset, size) of each tile as uint64, one record of all tiles per frame
+#
+# A tile is a (tile height, tile width, C) block of a frame, smaller at the right and bottom borders.
+# index.json is replaced last when a frame is added, so an interrupted export leaves a consistent store.
+
+INDEX_NAME = 'index.json'
+FILE_PATTERN = re.compile(r'^(.+)_(\d{4,})\.exr$')
+# Multi-layer EXR of all buffers of a frame written by automated.py's pack_frames, read by FrameLoader
+PACKED_NAME = 'frame_{frame:04d}.exr'
+PACKED_PATTERN = re.compile(r'^frame_(\d{4,})\.exr$')
+
+
+class DatasetWriter:
+    def __init__(self, store_dir, tile=(128, 128), level=4):
+        self.store_dir = store_dir
+        self.tile = tuple(tile)
+        self.level = level
+        os.makedirs(store_dir, exist_ok=True)
+        self.index = load_index(store_dir) or {'buffers': {}, 'cameras': {}}
+
+    def has_frame(self, buffer, frame):
+        return str(frame) in self.index['buffers'].get(buffer, {}).get('frames', {})
+
+    def add_frame(self, frame, buffers, channels=None):
+        # Append the (H, W, C) arrays of `buffers` (name -> array) for `frame` and update the index
+        channels = channels or {}
+        for name, img in buffers.items():
+            if img.ndim == 2:
+                img = img[:, :, np.newaxis]
+            meta = self.index['buffers'].setdefault(name, {
+                'shape': list(img.shape),
+                'dtype': img.dtype.str,
+                'channels': channels.get(name),
+                'tile': list(self.tile),
+                'frames': {},
+            })
+            if list(img.shape) != meta['shape'] or img.dtype.str != meta['dtype']:
+                raise Exception(f"Frame {frame} of '{name}' is {img.shape} {img.dtype.str}, expected {tuple(meta['shape'])} {meta['dtype']}.")
+            if str(frame) in meta['frames']:
+                continue
+
+            records = []
+            with open(os.path.join(self.store_dir, f'{name}.bin'), 'ab') as f:
+                for y0, x0, y1, x1 in tiles(meta):
+                    data = zlib.compress(np.ascontiguousarray(img[y0:y1, x0:x1]), self.level)
+                    records.append((f.tell(), len(data)))
+                    f.write(data)
+            idx_path = os.path.join(self.store_dir, f'{name}.idx')
+            slot = os.path.getsize(idx_path) // (16 * len(records)) if os.path.exists(idx_path) else 0
+            with open(idx_path, 'ab') as f:
+                f.write(np.array(records, dtype='<u8').tobytes())
+            meta['frames'][str(frame)] = slot
+        self.save()
+
+    def add_cameras(self, cameras, first_frame=None):
+        # Camera info entries written by CapturePass. Their frameIndex is the clock frame, while the
+        # buffers are numbered by capture from 0, one capture per frame from the first frame of the
+        # animation. The entries are keyed by capture index, frameIndex - first_frame, where
+        # first_frame defaults to the first frame in the camera info.
+        if not cameras:
+            return
+        if first_frame is None:
+            first_frame = min(camera['frameIndex'] for camera in cameras)
+        for camera in cameras:
+            self.index['cameras'][str(camera['frameIndex'] - first_frame)] = camera
+        self.save()
+
+    def save(self):
+        path = os.path.join(self.store_dir, INDEX_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+
+class DatasetReader:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = load_index(store_dir)
+        if self.index is None:
+            raise Exception(f'No dataset found in {store_dir}.')
+        self.buffers = self.index['buffers']
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._files = []
+
+    def frames(self, buffer):
+        return sorted(int(f) for f in self.buffers[buffer]['frames'])
+
+    def num_tiles(self, buffer):
+        meta = self.buffers[buffer]
+        (h, w, _), (th, tw) = meta['shape'], meta['tile']
+        return (-(-h // th), -(-w // tw))
+
+    def _file(self, buffer, ext):
+        # One handle per thread, since reads seek
+        files = self._local.__dict__.setdefault('files', {})
+        key = (buffer, ext)
+        if key not in files:
+            files[key] = open(os.path.join(self.store_dir, f'{buffer}.{ext}'), 'rb')
+            with self._lock:
+                self._files.append(files[key])
+        return files[key]
+
+    def read_tile(self, buffer, frame, ty, tx):
+        # O(1): one record lookup in the tile table and one read of the compressed tile
+        meta = self.buffers[buffer]
+        rows, cols = self.num_tiles(buffer)
+        slot = meta['frames'][str(frame)]
+        idx = self._file(buffer, 'idx')
+        idx.seek((slot * rows * cols + ty * cols + tx) * 16)
+        offset, size = np.frombuffer(idx.read(16), dtype='<u8')
+        data = self._file(buffer, 'bin')
+        data.seek(int(offset))
+        th, tw = meta['tile']
+        h, w, c = meta['shape']
+        shape = (min(th, h - ty * th), min(tw, w - tx * tw), c)
+        return np.frombuffer(zlib.decompress(data.read(int(size))), dtype=meta['dtype']).reshape(shape)
+
+    def read(self, buffer, frame, roi=None):
+        # A frame, or the crop roi = (x0, y0, x1, y1), assembled from the tiles it intersects
+        meta = self.buffers[buffer]
+        h, w, c = meta['shape']
+        th, tw = meta['tile']
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, w, h)
+        out = np.empty((y1 - y0, x1 - x0, c), dtype=meta['dtype'])
+        for ty in range(y0 // th, -(-y1 // th)):
+            for tx in range(x0 // tw, -(-x1 // tw)):
+                tile = self.read_tile(buffer, frame, ty, tx)
+                ty0, tx0 = ty * th, tx * tw
+                sy0, sy1 = max(y0, ty0), min(y1, ty0 + tile.shape[0])
+                sx0, sx1 = max(x0, tx0), min(x1, tx0 + tile.shape[1])
+                out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = tile[sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+        return out
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+        self._local = threading.local()
+
+
+BufferName = namedtuple('BufferName', ['base', 'suffix', 'kind'])
+
+def parse_buffer_name(name):
+    # 'normal2' -> ('normal', '2', 'secondinput'), 'ref_envLight' -> ('envLight', '', 'ref'),
+    # 'normal_multi' -> ('normal', '', 'multi'), 'albedo' -> ('albedo', '', 'input')
+    if name.startswith('ref_') or name == 'ref':
+        return BufferName(name[4:] or 'current', '', 'ref')
+    if name.endswith('_multi'):
+        return BufferName(name[:-len('_multi')], '', 'multi')
+    match = re.match(r'^(.*?)(\d+)$', name)
+    if match:
+        return BufferName(match.group(1), match.group(2), 'secondinput')
+    return BufferName(name, '', 'input')
+
+
+class FrameLoader:
+    """Loads the frames of a scene directory written by automated.py, or of a store exported by
+    `export_scene`, as dicts of buffers.
+
+    Iterating prefetches up to `prefetch` samples on `workers` threads. A sample is a dict of
+    the selected buffers, (H, W, C) arrays, or (window, H, W, C) for frames t-window+1..t, plus
+    'frame' for t. `crop` = (height, width) takes a random crop of the same region from all
+    buffers and frames of a sample. With `shared_memory` = k > 0, the arrays live in a ring of
+    multiprocessing.shared_memory blocks, e.g., to hand them to other processes by name through
+    `shared_memory_names` and the 'slot' of the sample. They stay valid until k more samples are yielded.
+    """
+    def __init__(self, source, buffers=None, kinds=None, window=1, prefetch=8, workers=4,
+                 crop=None, seed=0, precision=exr.FLOAT, shared_memory=0):
+        self.source = source
+        self.store = DatasetReader(source) if load_index(source) is not None else None
+        if self.store is not None:
+            available = {b: set(self.store.frames(b)) for b in self.store.buffers}
+        else:
+            self._files = scene_frames(source)
+            available = {}
+            for frame, files in self._files.items():
+                for b in files:
+                    available.setdefault(b, set()).add(frame)
+
+        self.buffers = list(buffers) if buffers is not None else sorted(available)
+        if kinds is not None:
+            self.buffers = [b for b in self.buffers if parse_buffer_name(b).kind in kinds]
+        missing = [b for b in self.buffers if b not in available]
+        if missing:
+            raise Exception(f'Buffers {missing} not found in {source}.')
+        self.names = {b: parse_buffer_name(b) for b in self.buffers}
+
+        # Frames t with all buffers of t-window+1..t
+        frames = set.intersection(*[available[b] for b in self.buffers]) if self.buffers else set()
+        self.window = window
+        self.frames = [t for t in sorted(frames) if all(t - k in frames for k in range(window))]
+        self.prefetch = max(1, prefetch)
+        self.workers = max(1, workers)
+        self.crop = crop
+        self.rng = np.random.default_rng(seed)
+        self.dtype = exr.NP_PRECISION[str(precision)]
+        self.precision = precision
+
+        self.full_shapes = {b: self._full_shape(b) for b in self.buffers} if self.frames else {}
+        self.shapes = {}
+        for b, shape in self.full_shapes.items():
+            if self.crop is not None:
+                shape = tuple(self.crop) + shape[2:]
+            self.shapes[b] = ((window,) if window > 1 else ()) + shape
+        self._ring = None
+        self.shared_memory_names = []
+        if shared_memory > 0:
+            self._allocate_ring(self.prefetch + 1 + shared_memory)
+
+    def _full_shape(self, buffer):
+        if self.store is not None:
+            return tuple(self.store.buffers[buffer]['shape'])
+        f, group = self._files[self.frames[0]][buffer]
+        return exr.open(os.path.join(self.source, f)).shape(group)
+
+    def _allocate_ring(self, size):
+        from multiprocessing import shared_memory
+        self._ring = []
+        for _ in range(size):
+            slot = {}
+            for b, shape in self.shapes.items():
+                block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(self.dtype).itemsize))
+                slot[b] = (block, np.ndarray(shape, dtype=self.dtype, buffer=block.buf))
+            self._ring.append(slot)
+        self.shared_memory_names = [{b: block.name for b, (block, _) in slot.items()} for slot in self._ring]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _roi(self):
+        # Random crop shared by the buffers of a sample, or None for full frames
+        if self.crop is None:
+            return None
+        h, w = self.full_shapes[self.buffers[0]][:2]
+        ch, cw = self.crop
+        y0 = int(self.rng.integers(0, h - ch + 1))
+        x0 = int(self.rng.integers(0, w - cw + 1))
+        return (x0, y0, x0 + cw, y0 + ch)
+
+    def _read(self, buffer, frame, roi, out):
+        if self.store is not None:
+            out[...] = self.store.read(buffer, frame, roi)
+            return
+        f, group = self._files[frame][buffer]
+        exr.open(os.path.join(self.source, f)).get(group, self.precision, out=out, roi=roi)
+
+    def load(self, index, roi=None, slot=None):
+        # Sample `index`, into the arrays of a shared memory slot if given
+        t = self.frames[index]
+        sample = {'frame': t}
+        if slot is not None:
+            sample['slot'] = slot
+        for b in self.buffers:
+            out = self._ring[slot][b][1] if slot is not None else np.empty(self.shapes[b], dtype=self.dtype)
+            if self.window > 1:
+                for k in range(self.window):
+                    self._read(b, t - self.window + 1 + k, roi, out[k])
+            else:
+                self._read(b, t, roi, out)
+            sample[b] = out
+        return sample
+
+    def __getitem__(self, index):
+        return self.load(index, self._roi())
+
+    def __iter__(self):
+        return self.iterate(range(len(self)))
+
+    def iterate(self, indices):
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for n, index in enumerate(indices):
+                # Crops are drawn here so that they do not depend on the thread schedule
+                slot = n % len(self._ring) if self._ring is not None else None
+                pending.append(executor.submit(self.load, index, self._roi(), slot))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def shuffled(self):
+        # Iterate in a random order, e.g., once per epoch
+        return self.iterate(self.rng.permutation(len(self)))
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        if self._ring is not None:
+            for slot in self._ring:
+                for block, _ in slot.values():
+                    block.close()
+                    block.unlink()
+            self._ring = None
+
+
+def load_index(store_dir):
+    path = os.path.join(store_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def tiles(meta):
+    # (y0, x0, y1, x1) of the tiles of a frame in row-major order
+    (h, w, _), (th, tw) = meta['shape'], meta['tile']
+    return [(y, x, min(y + th, h), min(x + tw, w)) for y in range(0, h, th) for x in range(0, w, tw)]
+
+
+def scene_frames(scene_dir):
+    # {frame: {buffer: (file, group)}} of a scene directory written by automated.py,
+    # from one EXR per buffer or from packed multi-layer frames
+    frames = {}
+    for f in sorted(os.listdir(scene_dir)):
+        packed = PACKED_PATTERN.match(f)
+        match = FILE_PATTERN.match(f)
+        if packed:
+            frame = int(packed.group(1))
+            for group in exr.open(os.path.join(scene_dir, f)).root_channels:
+                frames.setdefault(frame, {})[group] = (f, group)
+        elif match:
+            frames.setdefault(int(match.group(2)), {})[match.group(1)] = (f, 'default')
+    return frames
+
+
+def export_scene(scene_dir, store_dir, tile=(128, 128), level=4, first_frame=None):
+    # Add the frames of `scene_dir` that are not in the store yet, `first_frame` is the first
+    # animation frame (scene.defs[...]['anim'][0]) the cameras are numbered from
+    writer = DatasetWriter(store_dir, tile, level)
+    added = 0
+    for frame, buffers in sorted(scene_frames(scene_dir).items()):
+        todo = {b: v for b, v in buffers.items() if not writer.has_frame(b, frame)}
+        if not todo:
+            continue
+        images, channels = {}, {}
+        for buffer, (f, group) in todo.items():
+            img = exr.open(os.path.join(scene_dir, f))
+            # HALF buffers stay HALF
+            half = all(str(img.channel_precision[c]) == 'HALF' for c in img.channel_map[group])
+            images[buffer] = img.get(group, exr.HALF if half else exr.FLOAT)
+            channels[buffer] = [c.split('.')[-1] for c in img.channel_map[group]]
+        writer.add_frame(frame, images, channels)
+        added += 1
+
+    camera_path = os.path.join(scene_dir, 'camera_info.json')
+    if os.path.exists(camera_path):
+        try:
+            with open(camera_path, 'r') as f:
+                writer.add_cameras(json.load(f), first_frame)
+        except ValueError as e:
+            print(f'WARN: Failed to parse {camera_path}: {str(e)}')
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a scene directory written by automated.py to a chunked dataset')
+    parser.add_argument('scene_dir')
+    parser.add_argument('store_dir')
+    parser.add_argument('--tile', type=int, nargs=2, default=[128, 128], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--level', type=int, default=4, help='zlib compression level')
+    parser.add_argument('--first_frame', type=int, default=None, help='First animation frame of the scene, defaults to the first frame in camera_info.json')
+    args = parser.parse_args()
+
+    added = export_scene(args.scene_dir, args.store_dir, args.tile, args.level, args.first_frame)
+    print(f'Added {added} frames to {args.store_dir}.')
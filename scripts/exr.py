@@ -4,11 +4,25 @@ from builtins import *
 import OpenEXR, Imath
 import numpy as np
 import os, sys
-from collections import defaultdict
+import hashlib, threading
+from collections import defaultdict, OrderedDict
+try:
+  from collections.abc import Mapping
+except ImportError:
+  from collections import Mapping
+from concurrent.futures import ThreadPoolExecutor
+try:
+  from . import exr_numpy
+except ImportError:
+  import exr_numpy
 #import set
 
 # exr.py: Tools/helpers for various exr I/O operations
 
+# 'openexr' decodes everything with the OpenEXR binding, 'numpy' decodes and encodes NO/ZIPS/ZIP
+# scanline files with exr_numpy.py and falls back to OpenEXR for the others
+BACKEND = os.environ.get('EXR_BACKEND', 'openexr')
+
 FLOAT = Imath.PixelType(Imath.PixelType.FLOAT)
 HALF  = Imath.PixelType(Imath.PixelType.HALF)
 UINT  = Imath.PixelType(Imath.PixelType.UINT)
@@ -28,6 +42,10 @@ NP_PRECISION = {
 
 
 def open(filename):
+  if BACKEND == 'numpy':
+    f = exr_numpy.open(filename)
+    if f is not None:
+      return InputFile(f, filename)
   # Check if the file is an EXR file
   if not OpenEXR.isOpenExrFile(filename):
     raise Exception("File '%s' is not an EXR file." % filename)
@@ -35,18 +53,87 @@ def open(filename):
   return InputFile(OpenEXR.InputFile(filename), filename)
 
 
-def read(filename, channels = "default", precision = FLOAT):
+def read(filename, channels = "default", precision = FLOAT, out = None, roi = None):
+  if _cache is not None:
+    return _cache.read(filename, channels, precision, out, roi, _read)
+  return _read(filename, channels, precision, out, roi)
+
+def _read(filename, channels, precision, out, roi):
   f = open(filename)
   if _is_list(channels):
     # Construct an array of precisions
-    return f.get_dict(channels, precision=precision)
+    return f.get_dict(channels, precision=precision, out=out, roi=roi)
 
   else:
-    return f.get(channels, precision)
+    return f.get(channels, precision, out=out, roi=roi)
 
-def read_all(filename, precision = FLOAT):
+def read_all(filename, precision = FLOAT, out = None, roi = None):
+  if _cache is not None:
+    return _cache.read(filename, None, precision, out, roi, lambda fn, c, p, o, r: open(fn).get_all(precision=p, out=o, roi=r))
   f = open(filename)
-  return f.get_all(precision=precision)
+  return f.get_all(precision=precision, out=out, roi=roi)
+
+def open_lazy(filename, precision = FLOAT, roi = None):
+  # Like `read_all`, but the groups and channels are decoded on first access and cached
+  return LazyFile(open(filename), precision, roi)
+
+def probe(filename):
+  # Size, channels and compression from the header only, no pixels are decoded
+  f = OpenEXR.InputFile(filename)
+  try:
+    header = f.header()
+  finally:
+    f.close()
+  window = header['dataWindow']
+  return {
+    'width': window.max.x - window.min.x + 1,
+    'height': window.max.y - window.min.y + 1,
+    'channels': {name: str(c.type) for name, c in header['channels'].items()},
+    'compression': str(header['compression']).replace('_COMPRESSION', ''),
+  }
+
+def read_many(paths, channels = "default", precision = FLOAT, workers = None, stack = False, out = None, roi = None):
+  # Decode many files concurrently on a thread pool, OpenEXR releases the GIL while decoding.
+  # Returns (results, errors): the results in the order of `paths`, or a single (N, H, W, C) array
+  # if `stack` is set (a single group only), and a dict of the exception raised per failed path.
+  # Failed files are None in the results or NaN in the stacked array.
+  paths = list(paths)
+  if workers is None:
+    workers = min(len(paths), os.cpu_count() or 1)
+  errors = {}
+
+  if stack:
+    if _is_list(channels):
+      raise Exception("Only a single group can be stacked.")
+    shape = None
+    for path in paths:
+      try:
+        shape = (len(paths),) + open(path).shape(channels, roi)
+        break
+      except Exception as e:
+        errors[path] = e
+    if shape is None:
+      return None, errors
+    results = _check_out(out, shape, NP_PRECISION[str(precision)])
+    read_one = lambda i: read(paths[i], channels, precision, out=results[i], roi=roi)
+  else:
+    results = [None] * len(paths)
+    read_one = lambda i: read(paths[i], channels, precision, roi=roi)
+
+  def task(i):
+    try:
+      value = read_one(i)
+      if not stack:
+        results[i] = value
+    except (Exception, SystemExit) as e:
+      # `get` exits on missing channels, which must not end the batch
+      errors[paths[i]] = e
+      if stack:
+        results[i] = np.nan
+
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    list(executor.map(task, range(len(paths))))
+  return results, errors
 
 def write(filename, data, channel_names = None, precision = FLOAT, compression = PIZ_COMPRESSION):
 
@@ -73,9 +160,8 @@ def write(filename, data, channel_names = None, precision = FLOAT, compression =
   # Case 1, the `data` argument is a dictionary
   #
   if isinstance(data, dict):
-    # Make sure everything has ndims 3
-    for group, matrix in data.items():
-      data[group] = make_ndims_3(matrix)
+    # Make sure everything has ndims 3, without modifying the caller's dictionary
+    data = {group: make_ndims_3(matrix) for group, matrix in data.items()}
 
     # Prepare precisions
     if not isinstance(precision, dict):
@@ -89,8 +175,7 @@ def write(filename, data, channel_names = None, precision = FLOAT, compression =
     channel_names = {group: get_channel_names(channel_names.get(group), matrix.shape[2]) for group, matrix in data.items()}
 
     # Collect channels
-    channels = {}
-    channel_data = {}
+    groups = []
     width = None
     height = None
     for group, matrix in data.items():
@@ -104,20 +189,12 @@ def write(filename, data, channel_names = None, precision = FLOAT, compression =
       # Check the number of channel names
       if len(names) != depth:
         raise Exception("Depth does not match the number of channel names for channel '%s'" % group)
-      for i, c in enumerate(names):
-        if group == "default":
-          channel_name = c
-        else:
-          channel_name = "%s.%s" % (group, c)
-        channels[channel_name] = Imath.Channel(precisions[group])
-        channel_data[channel_name] = matrix[:,:,i].astype(NP_PRECISION[str(precisions[group])]).tostring()
+      if group != "default":
+        names = ["%s.%s" % (group, c) for c in names]
+      groups.append((names, precisions[group], matrix))
 
     # Save
-    header = OpenEXR.Header(width, height)
-    header['compression'] = compression
-    header['channels'] = channels
-    out = OpenEXR.OutputFile(filename, header)
-    out.writePixels(channel_data)
+    _write_channels(filename, width, height, groups, compression)
 
   #
   # Case 2, the `data` argument is one matrix
@@ -126,16 +203,39 @@ def write(filename, data, channel_names = None, precision = FLOAT, compression =
     data = make_ndims_3(data)
     height, width, depth = data.shape
     channel_names = get_channel_names(channel_names, depth)
-    header = OpenEXR.Header(width, height)
-    header['compression'] = compression
-    header['channels'] = {c: Imath.Channel(precision) for c in channel_names}
-    out = OpenEXR.OutputFile(filename, header)
-    out.writePixels({c: data[:,:,i].astype(NP_PRECISION[str(precision)]).tostring() for i, c in enumerate(channel_names)})
+    _write_channels(filename, width, height, [(channel_names, precision, data)], compression)
 
   else:
     raise Exception("Invalid precision for the `data` argument. Supported are NumPy arrays and dictionaries.")
 
 
+def _write_channels(filename, width, height, groups, compression):
+  # `groups` lists (channel names, precision, (H, W, C) matrix)
+  channels = {}
+  for names, p, matrix in groups:
+    planes = _planar(matrix, NP_PRECISION[str(p)])
+    for i, c in enumerate(names):
+      channels[c] = (p, planes[i])
+
+  codec = getattr(exr_numpy, str(compression), None)
+  if BACKEND == 'numpy' and codec in exr_numpy.LINES_PER_CHUNK:
+    exr_numpy.write(filename, {c: (_PIXEL_TYPE_CODE[str(p)], m) for c, (p, m) in channels.items()}, codec)
+    return
+
+  header = OpenEXR.Header(width, height)
+  header['compression'] = compression
+  header['channels'] = {c: Imath.Channel(p) for c, (p, m) in channels.items()}
+  out = OpenEXR.OutputFile(filename, header)
+  # The planes are handed over through the buffer protocol, without a bytes copy
+  out.writePixels({c: memoryview(m) for c, (p, m) in channels.items()})
+
+
+def _planar(matrix, dtype):
+  # Channels of a (H, W, C) matrix as contiguous (C, H, W) planes of `dtype`, converting the layout
+  # and casting in one copy, or none if the matrix already is planar with the right dtype
+  return np.ascontiguousarray(matrix.transpose(2, 0, 1), dtype=dtype)
+
+
 def tonemap(matrix, gamma=2.2):
   return np.clip(matrix ** (1.0/gamma), 0, 1)
 
@@ -148,15 +248,23 @@ class InputFile(object):
     if not input_file.isComplete():
       raise Exception("EXR file '%s' is not ready." % filename)
 
-    header = input_file.header()
-    dw     = header['dataWindow']
-
-    self.width             = dw.max.x - dw.min.x + 1
-    self.height            = dw.max.y - dw.min.y + 1
-    self.channels          = sorted(header['channels'].keys(),key=_channel_sort_key)
+    if isinstance(input_file, exr_numpy.ScanlineFile):
+      self.width             = input_file.width
+      self.height            = input_file.height
+      self.min_y             = input_file.data_window[1]
+      channel_types          = {c: _PIXEL_TYPES[t] for c, t in input_file.channels.items()}
+    else:
+      header = input_file.header()
+      dw     = header['dataWindow']
+      self.width             = dw.max.x - dw.min.x + 1
+      self.height            = dw.max.y - dw.min.y + 1
+      self.min_y             = dw.min.y
+      channel_types          = {c: v.type for c, v in header['channels'].items()}
+
+    self.channels          = sorted(channel_types.keys(),key=_channel_sort_key)
     self.depth             = len(self.channels)
-    self.precisions        = [c.type for c in header['channels'].values()]
-    self.channel_precision = {c: v.type for c, v in header['channels'].items()}
+    self.precisions        = list(channel_types.values())
+    self.channel_precision = channel_types
     self.channel_map       = defaultdict(list)
     self.root_channels     = set()
     self._init_channel_map()
@@ -184,7 +292,21 @@ class InputFile(object):
         channels = self.channel_map[group]
         print("%-20s%s" % (group, ",".join([c[len(group)+1:] for c in channels])))
 
-  def get(self, group = 'default', precision=FLOAT):
+  def shape(self, group = 'default', roi = None):
+    # Shape of the matrix returned by `get` for a group, e.g. to allocate `out`
+    x0, y0, x1, y1 = self._roi(roi)
+    return (y1 - y0, x1 - x0, len(self.channel_map[group]))
+
+  def _roi(self, roi):
+    # Region of interest (x0, y0, x1, y1) in pixels of the data window, end exclusive
+    if roi is None:
+      return (0, 0, self.width, self.height)
+    x0, y0, x1, y1 = roi
+    if not (0 <= x0 < x1 <= self.width and 0 <= y0 < y1 <= self.height):
+      raise Exception("Invalid roi %s for a %dx%d image." % (roi, self.width, self.height))
+    return (x0, y0, x1, y1)
+
+  def get(self, group = 'default', precision=FLOAT, out=None, roi=None):
     channels = self.channel_map[group]
 
     if len(channels) == 0:
@@ -193,22 +315,19 @@ class InputFile(object):
       self.describe_channels()
       sys.exit()
 
-    strings = self.input_file.channels(channels)
-
-    matrix = np.zeros((self.height, self.width, len(channels)), dtype=NP_PRECISION[str(precision)])
-    for i, string in enumerate(strings):
-      precision = NP_PRECISION[str(self.channel_precision[channels[i]])]
-      matrix[:,:,i] = np.fromstring(string, dtype = precision) \
-                        .reshape(self.height, self.width)
+    matrix = _check_out(out, self.shape(group, roi), NP_PRECISION[str(precision)])
+    self._read_into(channels, [matrix[:,:,i] for i in range(len(channels))], roi)
     return matrix
 
-  def get_all(self, precision = {}):
-    return self.get_dict(self.root_channels, precision)
+  def get_all(self, precision = {}, out = None, roi = None):
+    return self.get_dict(self.root_channels, precision, out=out, roi=roi)
 
-  def get_dict(self, groups = [], precision = {}):
+  def get_dict(self, groups = [], precision = {}, out = None, roi = None):
 
     if not isinstance(precision, dict):
       precision = {group: precision for group in groups}
+    if out is None:
+      out = {}
 
     return_dict = {}
     todo = []
@@ -223,7 +342,7 @@ class InputFile(object):
         p = precision[group]
       else:
         p = FLOAT
-      matrix = np.zeros((self.height, self.width, len(group_chans)), dtype=NP_PRECISION[str(p)])
+      matrix = _check_out(out.get(group), self.shape(group, roi), NP_PRECISION[str(p)])
       return_dict[group] = matrix
       for i, c in enumerate(group_chans):
         todo.append({'group': group, 'id': i, 'channel': c})
@@ -234,15 +353,243 @@ class InputFile(object):
       self.describe_channels()
       sys.exit()
 
-    strings = self.input_file.channels([c['channel'] for c in todo])
-
-    for i, item in enumerate(todo):
-      precision = NP_PRECISION[str(self.channel_precision[todo[i]['channel']])]
-      return_dict[item['group']][:,:,item['id']] = \
-          np.fromstring(strings[i], dtype = precision) \
-            .reshape(self.height, self.width)
+    self._read_into([c['channel'] for c in todo], [return_dict[c['group']][:,:,c['id']] for c in todo], roi)
     return return_dict
 
+  def _read_into(self, channels, dests, roi=None):
+    # Only the scanlines of the region of interest are decoded
+    x0, y0, x1, y1 = self._roi(roi)
+    if isinstance(self.input_file, exr_numpy.ScanlineFile):
+      # Chunks are decompressed in parallel straight into `dests`
+      self.input_file.read_into(channels, dests, (x0, y0, x1, y1))
+      return
+    strings = self.input_file.channels(channels, scanLine1=self.min_y + y0, scanLine2=self.min_y + y1 - 1)
+    for string, channel, dest in zip(strings, channels, dests):
+      self._decode(string, channel, dest, x0, x1)
+
+  def _decode(self, string, channel, dest, x0=0, x1=None):
+    # View the decoded bytes without copying and convert straight into `dest`
+    precision = NP_PRECISION[str(self.channel_precision[channel])]
+    dest[...] = np.frombuffer(string, dtype = precision).reshape(-1, self.width)[:, x0:x1]
+
+
+class LazyFile(Mapping):
+  # Mapping of the root channel groups of an `InputFile`, e.g. f['default'], decoded on first access.
+  # `take` decodes single channels of a group, e.g. f.take('default', [0]) for depth from linearZ.
+
+  def __init__(self, input_file, precision=FLOAT, roi=None):
+    self.input_file = input_file
+    self.precision = precision
+    self.roi = roi
+    self._groups = {}
+    self._channels = {}
+
+  def _dtype(self, group):
+    p = self.precision.get(group, FLOAT) if isinstance(self.precision, dict) else self.precision
+    return NP_PRECISION[str(p)]
+
+  def __getitem__(self, group):
+    if group not in self.input_file.root_channels:
+      raise KeyError(group)
+    if group not in self._groups:
+      names = self.input_file.channel_map[group]
+      matrix = np.empty(self.input_file.shape(group, self.roi), dtype=self._dtype(group))
+      cached = [i for i, c in enumerate(names) if c in self._channels]
+      for i in cached:
+        matrix[:,:,i] = self._channels[names[i]]
+      todo = [i for i in range(len(names)) if i not in cached]
+      self.input_file._read_into([names[i] for i in todo], [matrix[:,:,i] for i in todo], self.roi)
+      for i, c in enumerate(names):
+        self._channels[c] = matrix[:,:,i]
+      self._groups[group] = matrix
+    return self._groups[group]
+
+  def take(self, group, indices):
+    # Channels `indices` of a group as a (H, W, len(indices)) matrix, only decoding those channels
+    if group in self._groups:
+      return self._groups[group][:,:,indices]
+    names = [self.input_file.channel_map[group][i] for i in indices]
+    todo = [c for c in dict.fromkeys(names) if c not in self._channels]
+    shape = self.input_file.shape(group, self.roi)[:2]
+    dests = [np.empty(shape, dtype=self._dtype(group)) for _ in todo]
+    self.input_file._read_into(todo, dests, self.roi)
+    self._channels.update(zip(todo, dests))
+    return np.stack([self._channels[c] for c in names], axis=-1)
+
+  def __iter__(self):
+    return iter(sorted(self.input_file.root_channels))
+
+  def __len__(self):
+    return len(self.input_file.root_channels)
+
+
+class FrameCache(object):
+  # LRU cache of decoded `read`/`read_all` results bounded by bytes, enabled with `enable_cache`.
+  # Entries are keyed by (path, mtime, size, inode, channels, precision, roi): a file rewritten in
+  # place is a miss, and the entries of its previous version are dropped. Cached arrays are returned
+  # read-only, pass `out` to get a writable copy. Entries evicted from memory can spill to .npy files
+  # in `spill_dir`, bounded by `spill_bytes`, which are served memory-mapped.
+
+  def __init__(self, max_bytes, spill_dir=None, spill_bytes=0):
+    self.max_bytes = max_bytes
+    self.spill_dir = spill_dir
+    self.spill_bytes = spill_bytes if spill_dir else 0
+    self.entries = OrderedDict()  # key -> (value, nbytes)
+    self.spilled = OrderedDict()  # key -> (structure, files, nbytes)
+    self.nbytes = 0
+    self.spilled_nbytes = 0
+    self.versions = {}            # path -> stat part of the key
+    self.counters = dict(hits=0, spill_hits=0, misses=0, evictions=0, spills=0, invalidations=0)
+    self.lock = threading.RLock()
+    if spill_dir:
+      os.makedirs(spill_dir, exist_ok=True)
+
+  def read(self, filename, channels, precision, out, roi, loader):
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size, st.st_ino)
+    key = (path, version, _hashable(channels), _hashable(precision), tuple(roi) if roi is not None else None)
+    with self.lock:
+      if self.versions.get(path, version) != version:
+        self._invalidate(path)
+      self.versions[path] = version
+      value = self._get(key)
+    if value is None:
+      value = loader(filename, channels, precision, None, roi)
+      _set_readonly(value)
+      with self.lock:
+        self.counters['misses'] += 1
+        self._put(key, value)
+    if out is None:
+      return value
+    if isinstance(value, dict):
+      for group, matrix in value.items():
+        _check_out(out.get(group), matrix.shape, matrix.dtype)[...] = matrix
+      return out
+    _check_out(out, value.shape, value.dtype)[...] = value
+    return out
+
+  def _get(self, key):
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      self.counters['hits'] += 1
+      return self.entries[key][0]
+    if key in self.spilled:
+      # Served memory-mapped from the spill tier, which keeps the entry
+      self.spilled.move_to_end(key)
+      structure, files, nbytes = self.spilled[key]
+      arrays = [np.load(f, mmap_mode='r') for f in files]
+      self.counters['spill_hits'] += 1
+      return dict(zip(structure, arrays)) if structure is not None else arrays[0]
+    return None
+
+  def _put(self, key, value):
+    nbytes = _nbytes(value)
+    if nbytes > self.max_bytes:
+      return
+    self.entries[key] = (value, nbytes)
+    self.nbytes += nbytes
+    while self.nbytes > self.max_bytes:
+      old_key, (old_value, old_nbytes) = self.entries.popitem(last=False)
+      self.nbytes -= old_nbytes
+      self.counters['evictions'] += 1
+      self._spill(old_key, old_value, old_nbytes)
+
+  def _spill(self, key, value, nbytes):
+    if nbytes > self.spill_bytes:
+      return
+    while self.spilled and self.spilled_nbytes + nbytes > self.spill_bytes:
+      self._drop_spilled(next(iter(self.spilled)))
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    structure = list(value.keys()) if isinstance(value, dict) else None
+    arrays = list(value.values()) if structure is not None else [value]
+    files = []
+    for i, matrix in enumerate(arrays):
+      files.append(os.path.join(self.spill_dir, '%s_%d.npy' % (name, i)))
+      np.save(files[-1], matrix)
+    self.spilled[key] = (structure, files, nbytes)
+    self.spilled_nbytes += nbytes
+    self.counters['spills'] += 1
+
+  def _drop_spilled(self, key):
+    structure, files, nbytes = self.spilled.pop(key)
+    self.spilled_nbytes -= nbytes
+    for f in files:
+      self._remove(f)
+
+  def _remove(self, f):
+    try:
+      os.remove(f)
+    except OSError:
+      # Still memory-mapped on Windows, left for `clear`
+      pass
+
+  def _invalidate(self, path):
+    for key in [k for k in self.entries if k[0] == path]:
+      self.nbytes -= self.entries.pop(key)[1]
+      self.counters['invalidations'] += 1
+    for key in [k for k in self.spilled if k[0] == path]:
+      self._drop_spilled(key)
+      self.counters['invalidations'] += 1
+
+  def stats(self):
+    with self.lock:
+      return dict(self.counters, entries=len(self.entries), bytes=self.nbytes,
+                  spilled_entries=len(self.spilled), spilled_bytes=self.spilled_nbytes)
+
+  def clear(self):
+    with self.lock:
+      for key in list(self.spilled):
+        self._drop_spilled(key)
+      self.entries.clear()
+      self.nbytes = 0
+      self.versions.clear()
+
+
+_cache = None
+
+def enable_cache(max_bytes, spill_dir=None, spill_bytes=0):
+  # Cache the results of `read` and `read_all`, see `FrameCache`
+  global _cache
+  _cache = FrameCache(max_bytes, spill_dir, spill_bytes)
+  return _cache
+
+def disable_cache():
+  global _cache
+  if _cache is not None:
+    _cache.clear()
+  _cache = None
+
+def cache_stats():
+  return _cache.stats() if _cache is not None else None
+
+if os.environ.get('EXR_CACHE_BYTES'):
+  enable_cache(int(os.environ['EXR_CACHE_BYTES']))
+
+
+def _hashable(x):
+  if isinstance(x, dict):
+    return tuple(sorted((k, str(v)) for k, v in x.items()))
+  if _is_list(x):
+    return tuple(x)
+  return str(x) if isinstance(x, Imath.PixelType) else x
+
+def _nbytes(value):
+  return sum(m.nbytes for m in value.values()) if isinstance(value, dict) else value.nbytes
+
+def _set_readonly(value):
+  for m in (value.values() if isinstance(value, dict) else [value]):
+    m.flags.writeable = False
+
+
+def _check_out(out, shape, dtype):
+  # Allocate the destination matrix, or validate a caller-supplied one for reuse
+  if out is None:
+    return np.empty(shape, dtype=dtype)
+  if out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+    raise Exception("Invalid `out` buffer: expected contiguous %s %s, got %s %s." % (shape, np.dtype(dtype), out.shape, out.dtype))
+  return out
+
 
 def _sort_dictionary(key):
   if key == 'R' or key == 'r':
@@ -267,6 +614,14 @@ def _channel_sort_key(i):
   return [_sort_dictionary(x) for x in i.split(".")]
 
 
+_PIXEL_TYPES = {
+  exr_numpy.UINT:  UINT,
+  exr_numpy.HALF:  HALF,
+  exr_numpy.FLOAT: FLOAT
+}
+_PIXEL_TYPE_CODE = {str(t): code for code, t in _PIXEL_TYPES.items()}
+
+
 _default_channel_names = {
   1: ['Z'],
   2: ['X','Y'],
@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scripts.exr as exr
+
+# exr_benchmark.py: Read and write throughput of the OpenEXR and NumPy backends of exr.py
+
+def timed(func, repeat):
+    # Best of `repeat` runs
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='EXR backend throughput')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--precision', default='FLOAT', choices=['FLOAT', 'HALF'])
+    parser.add_argument('--compressions', nargs='+', default=['NO', 'ZIPS', 'ZIP'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--files', help='Benchmark reading these files instead of synthetic ones', nargs='*')
+    args = parser.parse_args()
+
+    backends = ['openexr', 'numpy']
+    if args.files:
+        size = sum(np.prod(exr.open(f).shape('all')) * 4 for f in args.files)
+        for backend in backends:
+            exr.BACKEND = backend
+            t = timed(lambda: [exr.read_all(f) for f in args.files], args.repeat)
+            print(f'{backend:<8} read {len(args.files)} files: {t * 1000:8.1f} ms, {size / t / 2**20:8.1f} MB/s')
+        return
+
+    # Smooth image with noise, compressing like a rendered frame
+    y, x = np.mgrid[0:args.height, 0:args.width].astype(np.float32)
+    img = np.stack([np.sin(x / 97 + c) * np.cos(y / 53) for c in range(args.channels)], axis=-1)
+    img += np.random.default_rng(0).normal(0, 0.01, img.shape).astype(np.float32)
+    precision = getattr(exr, args.precision)
+    size = img.size * np.dtype(exr.NP_PRECISION[args.precision]).itemsize
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f'{args.width}x{args.height}x{args.channels} {args.precision}, best of {args.repeat}')
+        for compression_name in args.compressions:
+            compression = getattr(exr, f'{compression_name}_COMPRESSION')
+            for backend in backends:
+                exr.BACKEND = backend
+                path = os.path.join(tmp_dir, f'{compression_name}_{backend}.exr')
+                write_time = timed(lambda: exr.write(path, img, precision=precision, compression=compression), args.repeat)
+                read_time = timed(lambda: exr.read(path), args.repeat)
+                file_size = os.path.getsize(path)
+                print(f'{compression_name:<5} {backend:<8} write {write_time * 1000:8.1f} ms {size / write_time / 2**20:8.1f} MB/s | '
+                      f'read {read_time * 1000:8.1f} ms {size / read_time / 2**20:8.1f} MB/s | {file_size / 2**20:6.1f} MB')
+
+if __name__ == '__main__':
+    main()
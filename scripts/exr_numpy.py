@@ -0,0 +1,248 @@
+import io
+import mmap
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# exr_numpy.py: Pure NumPy codec for single-part scanline EXR files with NO, ZIPS or ZIP compression.
+# The file is memory-mapped and its chunks are (de)compressed in parallel on a thread pool,
+# zlib and NumPy copies release the GIL.
+
+MAGIC = 20000630
+
+# Compression codes of the header, and scanlines per chunk of the supported ones
+NO_COMPRESSION   = 0
+ZIPS_COMPRESSION = 2
+ZIP_COMPRESSION  = 3
+LINES_PER_CHUNK = {NO_COMPRESSION: 1, ZIPS_COMPRESSION: 1, ZIP_COMPRESSION: 16}
+
+# Pixel type codes of the header
+UINT  = 0
+HALF  = 1
+FLOAT = 2
+PIXEL_DTYPE = {UINT: np.dtype('<u4'), HALF: np.dtype('<f2'), FLOAT: np.dtype('<f4')}
+
+_TILED      = 0x200
+_LONG_NAMES = 0x400
+_NON_IMAGE  = 0x800
+_MULTIPART  = 0x1000
+
+THREADS = os.cpu_count() or 1
+ZIP_LEVEL = 4 # OpenEXR default
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _map(func, items):
+  global _executor
+  items = list(items)
+  if THREADS <= 1 or len(items) <= 1:
+    return [func(item) for item in items]
+  # Files are read from several threads at once, only the first call may create the pool
+  if _executor is None:
+    with _executor_lock:
+      if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=THREADS)
+  return list(_executor.map(func, items))
+
+
+def open(filename):
+  # Returns a `ScanlineFile`, or None if the file needs the OpenEXR backend
+  f = ScanlineFile(filename)
+  return f if f.supported else None
+
+
+def _mmap(filename):
+  with io.open(filename, 'rb') as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ScanlineFile(object):
+  # The file is only mapped while parsing the header and while decoding, so it can be moved or
+  # removed (on Windows) as soon as it has been read.
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.map = _mmap(filename)
+    try:
+      self._parse()
+    finally:
+      self.map.close()
+      self.map = None
+
+  def _parse(self):
+    self.file_size = len(self.map)
+    magic, version = struct.unpack_from('<ii', self.map, 0)
+    if magic != MAGIC:
+      raise Exception("File '%s' is not an EXR file." % self.filename)
+
+    self.channels = {}
+    self.compression = None
+    self.data_window = None
+    pos = self._parse_header(8)
+
+    flags = version & ~0xff
+    self.supported = (not flags & (_TILED | _NON_IMAGE | _MULTIPART)
+                      and self.compression in LINES_PER_CHUNK
+                      and all(s == (1, 1) for s in self._sampling.values()))
+    if not self.supported:
+      return
+
+    xmin, ymin, xmax, ymax = self.data_window
+    self.width = xmax - xmin + 1
+    self.height = ymax - ymin + 1
+    self.lines_per_chunk = LINES_PER_CHUNK[self.compression]
+    num_chunks = -(-self.height // self.lines_per_chunk)
+    self.offsets = np.frombuffer(self.map, dtype='<u8', count=num_chunks, offset=pos).copy()
+
+    # Byte offset of each channel within a scanline, channels are stored sorted by name
+    self.layout = {}
+    offset = 0
+    for name in sorted(self.channels, key=lambda c: c.encode()):
+      self.layout[name] = offset
+      offset += self.width * PIXEL_DTYPE[self.channels[name]].itemsize
+    self.line_bytes = offset
+
+  def _parse_header(self, pos):
+    self._sampling = {}
+    while True:
+      name, pos = self._string(pos)
+      if not name:
+        return pos
+      type_name, pos = self._string(pos)
+      size, = struct.unpack_from('<i', self.map, pos)
+      pos += 4
+      if name == 'channels':
+        end = pos + size
+        p = pos
+        while p < end:
+          channel, p = self._string(p)
+          if not channel:
+            break
+          pixel_type, _, xs, ys = struct.unpack_from('<iB3xii', self.map, p)
+          self.channels[channel] = pixel_type
+          self._sampling[channel] = (xs, ys)
+          p += 16
+      elif name == 'compression':
+        self.compression = self.map[pos]
+      elif name == 'dataWindow':
+        self.data_window = struct.unpack_from('<iiii', self.map, pos)
+      pos += size
+
+  def _string(self, pos):
+    end = self.map.find(b'\0', pos)
+    return self.map[pos:end].decode(), end + 1
+
+  def isComplete(self):
+    # Chunks are written after the offset table, which is filled last
+    return bool(np.all(self.offsets > 0) and np.all(self.offsets < self.file_size))
+
+  def _chunk(self, m, index):
+    # Uncompressed bytes of a chunk and its first scanline relative to the data window
+    offset = int(self.offsets[index])
+    y, size = struct.unpack_from('<ii', m, offset)
+    y -= self.data_window[1]
+    lines = min(self.lines_per_chunk, self.height - y)
+    data = m[offset + 8:offset + 8 + size]
+    if self.compression == NO_COMPRESSION or size == lines * self.line_bytes:
+      # Chunks which do not shrink are stored uncompressed
+      return y, lines, data
+    return y, lines, _unpredict(zlib.decompress(data))
+
+  def read_into(self, channels, dests, roi=None):
+    # Decode `channels` into `dests`, (H, W) arrays of any dtype and strides, in one pass over the
+    # chunks. With `roi` = (x0, y0, x1, y1) only the chunks intersecting rows y0 to y1 are decompressed
+    # and the crop is stored into (y1 - y0, x1 - x0) arrays.
+    x0, y0, x1, y1 = roi if roi is not None else (0, 0, self.width, self.height)
+    first = y0 // self.lines_per_chunk
+    last = -(-y1 // self.lines_per_chunk)
+
+    def decode(index):
+      y, lines, data = self._chunk(m, index)
+      lo, hi = max(y, y0), min(y + lines, y1)
+      for name, dest in zip(channels, dests):
+        src = np.ndarray((lines, self.width), dtype=PIXEL_DTYPE[self.channels[name]], buffer=data,
+                         offset=self.layout[name], strides=(self.line_bytes, PIXEL_DTYPE[self.channels[name]].itemsize))
+        dest[lo - y0:hi - y0] = src[lo - y:hi - y, x0:x1]
+
+    m = _mmap(self.filename)
+    try:
+      _map(decode, range(first, last))
+    finally:
+      m.close()
+
+
+def _unpredict(raw):
+  # Undo the ZIP byte predictor and split of even and odd bytes
+  t = np.frombuffer(raw, dtype=np.uint8).copy()
+  t[1:] -= 128
+  np.cumsum(t, dtype=np.uint8, out=t)
+  out = np.empty_like(t)
+  half = (len(t) + 1) // 2
+  out[0::2] = t[:half]
+  out[1::2] = t[half:]
+  return out
+
+
+def _predict(raw):
+  t = np.empty(len(raw), dtype=np.uint8)
+  half = (len(raw) + 1) // 2
+  t[:half] = raw[0::2]
+  t[half:] = raw[1::2]
+  d = np.empty_like(t)
+  d[:1] = t[:1]
+  np.subtract(t[1:], t[:-1], out=d[1:])
+  d[1:] += 128
+  return d
+
+
+def write(filename, channels, compression=ZIP_COMPRESSION):
+  # Write `channels` (name -> (pixel type, (H, W) array)) as a scanline file
+  if compression not in LINES_PER_CHUNK:
+    raise Exception("Unsupported compression %d." % compression)
+  names = sorted(channels, key=lambda c: c.encode())
+  height, width = channels[names[0]][1].shape
+  planes = [np.ascontiguousarray(channels[c][1], dtype=PIXEL_DTYPE[channels[c][0]]).view(np.uint8) for c in names]
+
+  def attribute(name, type_name, value):
+    return name.encode() + b'\0' + type_name.encode() + b'\0' + struct.pack('<i', len(value)) + value
+
+  chlist = b''.join(c.encode() + b'\0' + struct.pack('<iB3xii', channels[c][0], 0, 1, 1) for c in names) + b'\0'
+  window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+  header = b''.join([
+    attribute('channels', 'chlist', chlist),
+    attribute('compression', 'compression', bytes([compression])),
+    attribute('dataWindow', 'box2i', window),
+    attribute('displayWindow', 'box2i', window),
+    attribute('lineOrder', 'lineOrder', b'\0'),
+    attribute('pixelAspectRatio', 'float', struct.pack('<f', 1)),
+    attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0, 0)),
+    attribute('screenWindowWidth', 'float', struct.pack('<f', 1)),
+  ]) + b'\0'
+  flags = _LONG_NAMES if any(len(c) > 31 for c in names) else 0
+
+  lines_per_chunk = LINES_PER_CHUNK[compression]
+  def encode(y):
+    lines = min(lines_per_chunk, height - y)
+    raw = np.concatenate([p[y:y + lines] for p in planes], axis=1).reshape(-1)
+    data = raw
+    if compression != NO_COMPRESSION:
+      compressed = zlib.compress(_predict(raw), ZIP_LEVEL)
+      if len(compressed) < len(raw):
+        data = compressed
+    return struct.pack('<ii', y, len(data)) + memoryview(data).cast('B')
+
+  chunks = _map(encode, range(0, height, lines_per_chunk))
+  offsets = np.cumsum([0] + [len(c) for c in chunks[:-1]], dtype='<u8')
+  offsets += 8 + len(header) + 8 * len(chunks)
+  with io.open(filename, 'wb') as f:
+    f.write(struct.pack('<ii', MAGIC, 2 | flags))
+    f.write(header)
+    f.write(offsets.tobytes())
+    for c in chunks:
+      f.write(c)
+
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+
+try:
+    from . import exr
+    from .dataset import PACKED_PATTERN, parse_buffer_name
+except ImportError:
+    import exr
+    from dataset import PACKED_PATTERN, parse_buffer_name
+
+# manifest.py: Index of the EXR files of a directory, so post-processing queries files by frame, buffer
+# and sample instead of listing the directory again for every frame
+#
+# <dir>/.manifest.json      File name -> mtime, size, parsed name and header (size, channels, compression)
+#
+# An update scans the directory once and parses the names of new or changed files. Headers are only
+# probed when asked for and are kept until the file changes; a file which cannot be probed yet, e.g.,
+# while it is written, keeps a null header and is probed again on the next request. A manifest which
+# is not persisted, e.g., of a transient job directory, is built from the file names alone.
+
+MANIFEST_NAME = '.manifest.json'
+VERSION = 1
+FILE_PATTERN = re.compile(r'^(?:(\d{4})_)?(.+)_(\d{4,})\.exr$')
+
+
+def parse_file_name(filename):
+    # '0003_roughness2_0100.exr' -> sample 3, buffer 'roughness2' ('roughness', '2', 'secondinput'), frame 100
+    match = FILE_PATTERN.match(filename)
+    if not match:
+        return None
+    sample, buffer, frame = match.groups()
+    if PACKED_PATTERN.match(filename):
+        base, suffix, kind = None, '', 'packed'
+    else:
+        base, suffix, kind = parse_buffer_name(buffer)
+    return {
+        'sample': int(sample) if sample is not None else None,
+        'buffer': buffer,
+        'base': base,
+        'suffix': suffix,
+        'kind': kind,
+        'frame': int(frame),
+    }
+
+
+class Manifest:
+    def __init__(self, directory, persist=True):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.persist = persist
+        self.entries = {}
+        self.probes = 0
+        if persist and os.path.exists(self.path):
+            try:
+                with open(self.path) as fp:
+                    index = json.load(fp)
+                if index.get('version') == VERSION:
+                    self.entries = index['files']
+            except (OSError, ValueError):
+                print(f'WARN: {self.path} is unreadable, rebuilding it.')
+        self.update()
+
+    def update(self):
+        # Rescan the directory, probing only files which are new or changed since the last scan
+        entries = {}
+        changed = False
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if not e.name.endswith('.exr') or not e.is_file():
+                    continue
+                if not self.persist:
+                    entry = parse_file_name(e.name)
+                    if entry is not None:
+                        entries[e.name] = dict(entry, mtime=None, size=None, header=None)
+                    continue
+                st = e.stat()
+                entry = self.entries.get(e.name)
+                if entry is None or entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+                    entry = self._entry(e.name, st)
+                    if entry is None:
+                        continue
+                    changed = True
+                entries[e.name] = entry
+        changed |= entries.keys() != self.entries.keys()
+        self.entries = entries
+        if changed:
+            self.save()
+        return self
+
+    def add(self, filename):
+        # Record a file written by the caller without rescanning
+        entry = self._entry(filename, os.stat(os.path.join(self.directory, filename)))
+        if entry is not None:
+            self.entries[filename] = entry
+
+    def remove(self, filename):
+        self.entries.pop(filename, None)
+
+    def rename(self, filename, new_name):
+        # The content is unchanged, so the header is kept and only the name is parsed again
+        entry = self.entries.pop(filename)
+        parsed = parse_file_name(new_name)
+        if parsed is not None:
+            entry.update(parsed)
+            self.entries[new_name] = entry
+
+    def _entry(self, filename, st):
+        entry = parse_file_name(filename)
+        if entry is None:
+            return None
+        entry.update(mtime=st.st_mtime_ns, size=st.st_size, header=None)
+        return entry
+
+    def save(self):
+        if not self.persist:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'version': VERSION, 'files': self.entries}, fp)
+        os.replace(tmp, self.path)
+
+    def files(self, frame=None, buffer=None, base=None, suffix=None, kind=None, sample=None, prefixed=None):
+        # Names of the files matching all given fields; `prefixed` selects files with (True) or
+        # without (False) a sample index prefix
+        query = {'frame': frame, 'buffer': buffer, 'base': base, 'suffix': suffix, 'kind': kind, 'sample': sample}
+        query = {k: v for k, v in query.items() if v is not None}
+        names = []
+        for name, entry in self.entries.items():
+            if prefixed is not None and (entry['sample'] is not None) != prefixed:
+                continue
+            if all(entry[k] == v for k, v in query.items()):
+                names.append(name)
+        return sorted(names)
+
+    def frames(self, **query):
+        return sorted({self.entries[name]['frame'] for name in self.files(**query)})
+
+    def header(self, filename):
+        # Probe the header on first use, None if the file cannot be probed (yet)
+        entry = self.entries[filename]
+        if entry['header'] is None:
+            try:
+                entry['header'] = exr.probe(os.path.join(self.directory, filename))
+                self.probes += 1
+            except Exception:
+                return None
+        return entry['header']
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def __len__(self):
+        return len(self.entries)